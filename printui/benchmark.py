@@ -0,0 +1,250 @@
+"""
+Benchmarks for rendering, preview encoding and printing, run against
+simulated printers so no hardware is needed. The results are written as
+JSON, so runs of different releases can be compared.
+
+    python -m printui.benchmark --font /path/to/font.ttf --output result.json
+"""
+
+import argparse
+import concurrent.futures
+import configparser
+import importlib
+import importlib.metadata
+import itertools
+import json
+import platform
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+import wsgiref.simple_server
+
+import bottle
+
+from .registry import Printer
+from .server import PooledWSGIServer
+from .simulator import SimulatedBackend
+
+# the package exports the main function under the name of the module
+service = importlib.import_module('.main', __package__)
+
+FONT_SIZES = (30, 70, 150)
+
+TEXTS = {
+    'short': 'Label',
+    'medium': 'The quick brown fox jumps over the lazy dog',
+    'long': '\n'.join(['The quick brown fox jumps over the lazy dog'] * 6),
+    }
+
+LABEL_SIZES = ('62', '29x90', '17x54')
+
+ORIENTATIONS = ('portrait', 'landscape')
+
+PREVIEW_FORMATS = {
+    'png': {},
+    'mono': {'mono': True},
+    'thumbnail': {'width': 300},
+    }
+
+def summarize(durations):
+    """
+    Return statistics in seconds for a list of durations
+    """
+    durations = sorted(durations)
+    return {
+        'iterations': len(durations),
+        'mean': statistics.fmean(durations),
+        'median': statistics.median(durations),
+        'stdev': statistics.stdev(durations) if len(durations) > 1 else 0.0,
+        'min': durations[0],
+        'max': durations[-1],
+        'p95': durations[min(len(durations) - 1, int(len(durations) * .95))],
+        }
+
+def measure(function, iterations, setup=None):
+    """
+    Call function iterations times, after one warm-up call, and return the
+    statistics of the durations. setup is called before each call and not
+    included in the measurement.
+    """
+    durations = []
+    for i in range(iterations + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        if i:
+            durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+def setup_service(fonts):
+    """
+    Configure the globals of the service like main() would, without a
+    configuration file and font discovery
+    """
+    config = configparser.ConfigParser()
+    config.read_dict(service.CONFIG_DEFAULTS)
+    service.DEFAULTS = config['defaults']
+    service.DEFAULTS['font_index'] = '0'
+    service.FONTS = [(path, path, '') for path in fonts]
+    service.CONFIG_RESPONSE = service.config_response()
+
+def bench_render(iterations):
+    results = []
+    for (font_size, (text_name, text), label_size, orientation) in itertools.product(
+            FONT_SIZES, TEXTS.items(), LABEL_SIZES, ORIENTATIONS):
+        params = {
+            'text': text,
+            'font_size': str(font_size),
+            'label_size': label_size,
+            'orientation': orientation,
+            }
+        result = measure(lambda: service.render_image(params),
+                         iterations, service.RENDER_CACHE.clear)
+        results.append(dict(result, name='render', params={
+            'font_size': font_size,
+            'text': text_name,
+            'label_size': label_size,
+            'orientation': orientation,
+            }))
+    return results
+
+def bench_preview(iterations):
+    results = []
+    for label_size, (text_name, text) in itertools.product(LABEL_SIZES, TEXTS.items()):
+        context = service.render_image({'text': text, 'label_size': label_size})
+        for format_name, options in PREVIEW_FORMATS.items():
+            result = measure(lambda: service.encode_preview(context, **options),
+                             iterations, context['cache_entry']['encoded'].clear)
+            results.append(dict(result, name='preview', params={
+                'format': format_name,
+                'text': text_name,
+                'label_size': label_size,
+                }))
+    return results
+
+class QuietRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def bench_print(requests, concurrency_levels, printers, latency):
+    """
+    Send print requests from concurrent clients to the service, which
+    prints on simulated printers taking latency seconds per job
+    """
+    for i in range(printers):
+        device = 'sim://QL-800/62?latency={}&id={}'.format(latency, i)
+        service.PRINTERS.add(Printer(device, service.print_label, 0)).start()
+
+    server_class = type('PooledWSGIServer', (PooledWSGIServer, ),
+                        {'workers': max(concurrency_levels)})
+    server = wsgiref.simple_server.make_server('127.0.0.1', 0, bottle.default_app(),
+                                               server_class=server_class,
+                                               handler_class=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/api/text/print'.format(server.server_port)
+
+    counter = itertools.count()
+
+    def send():
+        data = urllib.parse.urlencode({
+            # distinct texts, so each job is rendered and converted
+            'text': 'Label {}'.format(next(counter)),
+            'font_size': '70',
+            'wait': 'true',
+            }).encode()
+        start = time.perf_counter()
+        with urllib.request.urlopen(url, data) as response:
+            success = json.load(response)['success']
+        return (time.perf_counter() - start, success)
+
+    results = []
+    try:
+        for concurrency in concurrency_levels:
+            jobs_before = sum(SimulatedBackend.jobs.values())
+            start = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+                replies = list(executor.map(lambda i: send(), range(requests)))
+            elapsed = time.perf_counter() - start
+
+            results.append(dict(summarize([duration for duration, _ in replies]),
+                name='print',
+                params={
+                    'concurrency': concurrency,
+                    'printers': printers,
+                    'latency': latency,
+                    },
+                failed=sum(1 for _, success in replies if not success),
+                printed=sum(SimulatedBackend.jobs.values()) - jobs_before,
+                throughput=requests / elapsed,
+                ))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def environment():
+    def version(package):
+        try:
+            return importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            return None
+
+    return {
+        'printui': version('printui'),
+        'brother_ql': version('brother_ql'),
+        'pillow': version('pillow'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        }
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-f', '--font', action='append', required=True,
+                        help="Font file to render with, can be given several times.")
+    parser.add_argument('-o', '--output',
+                        help="File to write the results to (default: stdout).")
+    parser.add_argument('-n', '--iterations', type=int, default=20,
+                        help="Iterations of each render and preview benchmark.")
+    parser.add_argument('-r', '--requests', type=int, default=100,
+                        help="Print requests for each level of concurrency.")
+    parser.add_argument('-c', '--concurrency', default='1,4,16',
+                        help="Comma separated numbers of concurrent clients.")
+    parser.add_argument('-p', '--printers', type=int, default=1,
+                        help="Number of simulated printers.")
+    parser.add_argument('-l', '--latency', type=float, default=0,
+                        help="Seconds each simulated print job takes.")
+    parser.add_argument('-b', '--benchmark', action='append',
+                        choices=('render', 'preview', 'print'),
+                        help="Benchmarks to run (default: all).")
+    args = parser.parse_args()
+
+    setup_service(args.font)
+    benchmarks = args.benchmark or ['render', 'preview', 'print']
+
+    results = []
+    if 'render' in benchmarks:
+        results += bench_render(args.iterations)
+    if 'preview' in benchmarks:
+        results += bench_preview(args.iterations)
+    if 'print' in benchmarks:
+        concurrency_levels = [int(level) for level in args.concurrency.split(',')]
+        results += bench_print(args.requests, concurrency_levels,
+                               args.printers, args.latency)
+
+    report = {'environment': environment(), 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    run()
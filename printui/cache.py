@@ -0,0 +1,76 @@
+"""
+Module with small thread-safe caches used to avoid repeated work when
+rendering labels.
+"""
+
+import collections
+import threading
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least recently used entries once the
+    total weight of all entries exceeds maxsize. Without a weigh function
+    every entry has a weight of one, so maxsize is the number of entries.
+    All methods are thread-safe.
+    """
+    def __init__(self, maxsize, weigh=None):
+        self.maxsize = maxsize
+        self.weigh = weigh or (lambda value: 1)
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                (value, weight) = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        weight = self.weigh(value)
+        with self._lock:
+            if key in self._data:
+                self.weight -= self._data.pop(key)[1]
+            if weight > self.maxsize:
+                return
+            self._data[key] = (value, weight)
+            self._data.move_to_end(key)
+            self.weight += weight
+            while self.weight > self.maxsize:
+                self.weight -= self._data.popitem(last=False)[1][1]
+
+    def get_or_create(self, key, factory):
+        """
+        Return the cached value for key or call factory() to create and
+        store it. The factory runs without holding the lock.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'weight': self.weight,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            }
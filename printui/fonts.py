@@ -0,0 +1,150 @@
+"""
+Module for discovering the available fonts. Scanning all fonts with
+fontconfig takes seconds on systems with many fonts, so the result is kept
+in an index file and only rescanned when one of the font directories
+changed.
+"""
+
+import json
+import logging
+import os
+
+LOGGER = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+
+# Directories fontconfig searches by default. Changes to the configuration
+# of fontconfig itself aren't noticed, delete the index file after those.
+SYSTEM_FONT_DIRS = (
+    '/usr/share/fonts',
+    '/usr/local/share/fonts',
+    '~/.fonts',
+    os.path.join(os.environ.get('XDG_DATA_HOME', '~/.local/share'), 'fonts'),
+    )
+
+def default_index_file():
+    return os.path.join(os.path.expanduser(os.environ.get('XDG_CACHE_HOME', '~/.cache')),
+                        'printui', 'fonts.json')
+
+def scan_fonts(system_fonts, additional_paths):
+    """
+    Query fontconfig for all fonts
+
+    returns: list of tuples (path, family, style)
+    """
+    import fontconfig
+
+    if system_fonts:
+        fontconfig_instance = fontconfig.Config.get_current()
+    else:
+        fontconfig_instance = fontconfig.Config.create()
+
+    for folder in additional_paths:
+        fontconfig_instance.app_font_add_dir(folder)
+
+    props_to_query = (fontconfig.PROP.FILE, fontconfig.PROP.FAMILY, fontconfig.PROP.STYLE)
+
+    fonts = []
+    for font in fontconfig_instance.font_list(fontconfig.Pattern.create(), props_to_query):
+        fonts.append(tuple(font.get(prop, 0)[0] or '' for prop in props_to_query))
+    return fonts
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def font_directories(fonts, roots):
+    """
+    Return the modification times of all directories below the roots and
+    of all directories containing one of the fonts. Adding or removing a
+    font or a directory changes the time of the directory containing it.
+    """
+    directories = {}
+    for root in roots:
+        root = os.path.abspath(os.path.expanduser(root))
+        directories[root] = mtime(root)
+        for (path, _, _) in os.walk(root):
+            directories[path] = mtime(path)
+    for (path, _, _) in fonts:
+        directory = os.path.dirname(path)
+        if directory not in directories:
+            directories[directory] = mtime(directory)
+    return directories
+
+def read_index(index_file, key):
+    """
+    Return the fonts stored in the index file, or None if it is missing,
+    was created with different settings or any font directory changed
+    """
+    try:
+        with open(index_file) as index:
+            data = json.load(index)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        LOGGER.warning('Failed to read font index %s: %r', index_file, e)
+        return None
+
+    if data.get('version') != INDEX_VERSION or data.get('key') != key:
+        return None
+
+    for directory, directory_mtime in data['directories'].items():
+        if mtime(directory) != directory_mtime:
+            LOGGER.info('Font directory %s changed, rescanning fonts', directory)
+            return None
+
+    return [tuple(font) for font in data['fonts']]
+
+def write_index(index_file, key, fonts, directories):
+    try:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        temp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+        with open(temp_file, 'w') as index:
+            json.dump({
+                'version': INDEX_VERSION,
+                'key': key,
+                'directories': directories,
+                'fonts': fonts,
+                }, index)
+        os.replace(temp_file, index_file)
+    except OSError as e:
+        LOGGER.warning('Failed to write font index %s: %r', index_file, e)
+
+def load_fonts(system_fonts, additional_paths, index_file=None):
+    """
+    Return all fonts sorted by family and style, from the index file if it
+    is still valid and otherwise from a scan with fontconfig, which is
+    stored in the index file afterwards
+
+    returns: list of tuples (path, family, style)
+    """
+    additional_paths = [path.strip() for path in additional_paths if path.strip()]
+    key = {'system_fonts': system_fonts, 'additional_paths': additional_paths}
+
+    if index_file:
+        fonts = read_index(index_file, key)
+        if fonts is not None:
+            LOGGER.debug('Loaded %d fonts from %s', len(fonts), index_file)
+            return fonts
+
+    fonts = scan_fonts(system_fonts, additional_paths)
+    fonts.sort(key=lambda font: font[1:])
+
+    if index_file:
+        roots = (SYSTEM_FONT_DIRS if system_fonts else ()) + tuple(additional_paths)
+        write_index(index_file, key, fonts, font_directories(fonts, roots))
+
+    return fonts
+
+def group_by_family(fonts):
+    """
+    Group fonts by their family, keeping the order
+
+    returns: list of [family, [[index, style], ...]]
+    """
+    families = {}
+    for index, (_, family, style) in enumerate(fonts):
+        families.setdefault(family, []).append([index, style])
+    return [[family, styles] for family, styles in families.items()]
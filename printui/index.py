@@ -0,0 +1,23 @@
+"""
+Module with lookup tables for labels and models, built once on import so
+that hot paths don't have to scan the lists of brother_ql.
+"""
+
+import brother_ql.labels
+import brother_ql.models
+
+LABELS = tuple(brother_ql.labels.LabelsManager().iter_elements())
+
+MODELS = tuple(brother_ql.models.ModelsManager().iter_elements())
+
+LABELS_BY_IDENTIFIER = {label.identifier: label for label in LABELS}
+
+# several labels can share a tape size (e.g. 62 and 62red), the first one
+# is the one reported for a loaded roll
+LABELS_BY_TAPE_SIZE = {}
+for label in LABELS:
+    LABELS_BY_TAPE_SIZE.setdefault(label.tape_size, label)
+del label
+
+# the status reports models by their name, which is also their identifier
+MODELS_BY_IDENTIFIER = {model.identifier: model for model in MODELS}
@@ -0,0 +1,200 @@
+"""
+Module for queueing print jobs, so that requests don't have to wait for the
+printer and only one job at a time talks to a device.
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+import uuid
+
+from .printer import PrinterError
+
+LOGGER = logging.getLogger(__name__)
+
+JOB_STATES = ('queued', 'rendering', 'printing', 'done', 'failed')
+
+class JobError(RuntimeError):
+    """
+    Expected failure of a job, its message is reported as is
+    """
+
+class JobDeferred(Exception):
+    """
+    Raised by a handler whose job can't run yet. The job goes back into the
+    queue after delay seconds, with the messages telling what it waits for,
+    instead of keeping the worker from the jobs behind it.
+    """
+    def __init__(self, delay, messages=()):
+        super().__init__(delay, *messages)
+        self.delay = delay
+        self.messages = list(messages)
+
+def error_messages(error):
+    """
+    Turn an exception into a list of messages for the API
+    """
+    if isinstance(error, PrinterError):
+        return [e.description for e in error.errors]
+    if isinstance(error, JobError):
+        return [str(error)]
+    if isinstance(error, OSError):
+        return ['Failed to connect to printer.']
+    return [repr(error)]
+
+class Job(object):
+    """
+    A single print job with its parameters, current state and the time spent
+    in each state
+    """
+    def __init__(self, params, handler=None, items=None, device=None):
+        self.id = uuid.uuid4().hex
+        self.device = device
+        self.params = params
+        self.handler = handler
+        self.state = 'queued'
+        self.messages = []
+        self.items = items
+        self.result = None
+        self.created = time.time()
+        self.timings = {}
+        self.finished = threading.Event()
+        self._state_since = time.monotonic()
+
+    def set_state(self, state):
+        now = time.monotonic()
+        self.timings[self.state] = self.timings.get(self.state, 0) + now - self._state_since
+        self._state_since = now
+        self.state = state
+        if state in ('done', 'failed'):
+            self.finished.set()
+
+    def fail(self, messages):
+        self.messages = messages
+        self.set_state('failed')
+
+    def to_dict(self):
+        result = {
+            'id': self.id,
+            'printer': self.device,
+            'state': self.state,
+            'messages': self.messages,
+            'created': self.created,
+            'timings': dict(self.timings),
+            }
+        if self.items is not None:
+            result['items'] = [dict(item) for item in self.items]
+        return result
+
+class PrintQueue(object):
+    """
+    Queue of print jobs for one device, processed one after another by a
+    single worker thread. The handler, or the one passed along with a job,
+    is called with each job and is expected to advance its state to 'rendering' and 'printing'. Jobs are
+    marked 'done' when it returns and 'failed' when it raises, unless it
+    raises JobDeferred to be queued again later.
+    The last `history` jobs are kept for status queries.
+    """
+    def __init__(self, device, handler, history=1000):
+        self.device = device
+        self.handler = handler
+        self.history = history
+        self.jobs = collections.OrderedDict()
+        self.processed = 0
+        self.failed = 0
+        self.active = None
+        self.deferred = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='print-queue')
+        self._thread.start()
+
+    def submit(self, params, handler=None, items=None):
+        job = Job(params, handler, items, self.device)
+        with self._lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+        self._queue.put(job)
+        self.start()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def depth(self):
+        return self._queue.qsize() + self.deferred
+
+    def cancel(self, job):
+        """
+        Fail a job that is queued and not being processed
+
+        returns: False if the job already started or finished
+        """
+        with self._lock:
+            if job.state != 'queued' or job is self.active:
+                return False
+            job.fail(["Cancelled."])
+            return True
+
+    def _requeue(self, job):
+        with self._lock:
+            self.deferred -= 1
+        self._queue.put(job)
+
+    def load(self):
+        """
+        Number of jobs waiting or being processed
+        """
+        return self.depth() + (self.active is not None)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                if job.state != 'queued':
+                    # cancelled while waiting
+                    continue
+                self.active = job
+            try:
+                job.result = (job.handler or self.handler)(job)
+            except JobDeferred as e:
+                with self._lock:
+                    job.messages = e.messages
+                    job.set_state('queued')
+                    self.deferred += 1
+                    self.active = None
+                timer = threading.Timer(e.delay, self._requeue, (job, ))
+                timer.daemon = True
+                timer.start()
+                continue
+            except Exception as e:
+                if isinstance(e, (PrinterError, JobError)):
+                    LOGGER.warning('Job %s failed: %s',
+                                   job.id, ','.join(error_messages(e)))
+                else:
+                    LOGGER.error('Job %s failed with unhandled exception', job.id,
+                                 exc_info=e)
+                job.fail(error_messages(e))
+                self.failed += 1
+            else:
+                job.set_state('done')
+            self.active = None
+            self.processed += 1
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'busy': self.active is not None,
+            'processed': self.processed,
+            'failed': self.failed,
+            }
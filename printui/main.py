@@ -5,6 +5,7 @@ This is a web service to print labels on Brother QL label printers.
 """
 
 import math
+import os
 import sys
 import logging
 import random
@@ -13,17 +14,37 @@ import argparse
 import io
 import base64
 import functools
+import hashlib
+import gzip
+import time
+import json
+import csv
+import concurrent.futures
 import importlib.resources
 
 import PIL.ImageFont
-import PIL.ImageDraw
+import PIL.Image
 import bottle
-import fontconfig
 
 import brother_ql.conversion
 import brother_ql.raster
 
-from .printer import PrinterDevice, PrinterError
+from .printer import PrinterDevice, PrinterError, CONNECTIONS, PhaseTypes, status_info
+from .cache import LRUCache
+from .jobs import JobError, JobDeferred, error_messages
+from .registry import Printer, PrinterRegistry
+from .pool import WorkerPool, PoolBusy
+from .server import server_options, DEFAULT_WORKERS
+from .index import LABELS, LABELS_BY_IDENTIFIER, MODELS_BY_IDENTIFIER
+from . import simulator # registers the backend for sim:// devices
+from . import metrics
+from .fonts import load_fonts, group_by_family, default_index_file
+from .metrics import STAGE_SECONDS, REQUEST_SECONDS, PREVIEWS_SUPERSEDED
+from .preview import PreviewSessions
+from . import text as text_layout
+from .raster import convert_page
+from .templates import Template
+from .spool import Spool
 
 TEMPLATE_DIR = [importlib.resources.files(__package__).joinpath('views')]
 
@@ -33,6 +54,7 @@ if hasattr(brother_ql.labels.FormFactor, "PTOUCH_ENDLESS"):
 
 CONFIG_DEFAULTS = {
     'server': {
+        'server': 'threaded',
         },
     'logging': {
         'level': 'INFO',
@@ -41,9 +63,39 @@ CONFIG_DEFAULTS = {
     'fonts': {
         'system_fonts': 'true',
         'additional_paths': '',
+        'cache_size': '32',
+        'index_file': default_index_file(),
+        },
+    'cache': {
+        'render_memory': '64',
+        'raster_memory': '32',
+        'strip_memory': '16',
+        'measure_size': '1024',
+        },
+    'render': {
+        'workers': '0',
+        'queue_length': '16',
+        'processes': 'false',
+        'png_compress_level': '6',
+        },
+    'spool': {
+        'directory': '',
+        'retry_interval': '2',
+        'max_wait': '86400',
+        },
+    'preview': {
+        'stream': 'true',
+        'keepalive': '15',
+        'max_streams': '',
         },
     'printer': {
         'discover': 'linux_kernel,pyusb',
+        'idle_timeout': '60',
+        'health_check_interval': '30',
+        'status_interval': '2',
+        'status_max_age': '5',
+        'status_history': '64',
+        'max_batch_size': '500',
         },
     'defaults': {
         'text': '',
@@ -84,6 +136,39 @@ PARAMETER_TYPES = {
 
 LOGGER = logging.getLogger(__name__)
 
+def render_weight(entry):
+    """
+    Approximate memory usage of a render cache entry in bytes
+    """
+    (width, height) = entry['image'].size
+    return width * height + sum(len(data) for data in entry['encoded'].values())
+
+FONT_CACHE = LRUCache(int(CONFIG_DEFAULTS['fonts']['cache_size']))
+RENDER_CACHE = LRUCache(int(CONFIG_DEFAULTS['cache']['render_memory']) << 20,
+                        weigh=render_weight)
+PRINTERS = PrinterRegistry()
+RASTER_CACHE = LRUCache(int(CONFIG_DEFAULTS['cache']['raster_memory']) << 20,
+                        weigh=len)
+STRIP_CACHE = LRUCache(int(CONFIG_DEFAULTS['cache']['strip_memory']) << 20,
+                       weigh=lambda strip: strip[0].width * strip[0].height)
+MEASURE_CACHE = LRUCache(int(CONFIG_DEFAULTS['cache']['measure_size']))
+PNG_COMPRESS_LEVEL = int(CONFIG_DEFAULTS['render']['png_compress_level'])
+RENDER_POOL = WorkerPool(int(CONFIG_DEFAULTS['render']['workers']),
+                         int(CONFIG_DEFAULTS['render']['queue_length']))
+# server workers left for other requests by default when previews are
+# streamed
+STREAM_FREE_WORKERS = 4
+PREVIEW_SESSIONS = PreviewSessions(
+        max_streams=DEFAULT_WORKERS - STREAM_FREE_WORKERS)
+PREVIEW_STREAM = CONFIG_DEFAULTS['preview']['stream'] == 'true'
+PREVIEW_KEEPALIVE = float(CONFIG_DEFAULTS['preview']['keepalive'])
+LABEL_TEMPLATES = {}
+SPOOL = None
+SPOOL_RETRY_INTERVAL = float(CONFIG_DEFAULTS['spool']['retry_interval'])
+SPOOL_MAX_WAIT = float(CONFIG_DEFAULTS['spool']['max_wait'])
+# Seconds a print request with wait set waits for its job
+WAIT_TIMEOUT = 30
+
 def exception_to_json(func):
     """
     Wrapper for all API endpoints that catches exeptions and instead
@@ -92,13 +177,20 @@ def exception_to_json(func):
     @functools.wraps(func)
     def wrapper_decorator(*args, **kwargs):
         try:
-            return func(*args, **kwargs)
+            with REQUEST_SECONDS.time(endpoint=func.__name__):
+                return func(*args, **kwargs)
 
         except PrinterError as e:
             messages = [error.description for error in e.errors]
             LOGGER.warning('Printer returned an error: %s', ','.join(messages))
             return {'success': False, 'messages': messages}
 
+        except PoolBusy as e:
+            LOGGER.info('Rejected request: %s', e)
+            bottle.response.status = 503
+            bottle.response.set_header('Retry-After', '1')
+            return {'success': False, 'busy': True, 'messages': [str(e)]}
+
         except Exception as e:
             LOGGER.error('Request failed with unhandled exception', exc_info=e)
             if isinstance(e, OSError):
@@ -122,61 +214,289 @@ def serve_static(filename):
 def labeldesigner():
     return {'static_url': WEBSITE['static_url']}
 
-def render_image(request, printer = None):
+def load_font(font_index, font_size):
     """
-    Common function to render a label for preview and printing
+    Return the FreeTypeFont for the given index into FONTS and size, loading
+    the font file only if it isn't cached already
     """
+    try:
+        font_path = FONTS[font_index][0]
+    except IndexError:
+        raise LookupError("Couln't find the font with index {}"\
+                .format(font_index))
 
-    data = request.params.decode() # UTF-8 decoded form data
+    return FONT_CACHE.get_or_create((font_index, font_size),
+            lambda: PIL.ImageFont.truetype(font_path, font_size))
 
+RENDER_KEY_PARAMETERS = ('text', 'font_index', 'font_size', 'label_size',
+                         'align', 'align_vertical', 'orientation',
+                         'margin_top', 'margin_bottom', 'margin_left',
+                         'margin_right')
+
+def render_key(context):
+    """
+    Build the key identifying a rendered label from the normalized context.
+    The font path is included so that the key stays valid if the font
+    list changes between restarts.
+    """
+    return (FONTS[context['font_index']][0], ) + \
+            tuple(context[name] for name in RENDER_KEY_PARAMETERS)
+
+# value of font_size to use the largest size at which the text fits
+FIT_FONT_SIZE = 'fit'
+# largest font size tried for FIT_FONT_SIZE
+MAX_FONT_SIZE = 1000
+
+MARGINS = ('margin_top', 'margin_bottom', 'margin_left', 'margin_right')
+
+def parse_parameters(data):
+    """
+    Convert a mapping of parameters to their types, with the defaults for
+    missing ones and the margins in pixels. With font_size "fit" the
+    margins stay in percent of the font size until fit_font_size() chose
+    the size.
+    """
     context = {}
 
     for name, datatype in PARAMETER_TYPES.items():
-        context[name] = datatype(data.get(name, DEFAULTS[name]))
+        value = data.get(name, DEFAULTS[name])
+        if name == 'font_size' and value == FIT_FONT_SIZE:
+            context[name] = value
+            continue
+        try:
+            context[name] = datatype(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid value for parameter '{}': {!r}".format(name, value))
+
+    if context['font_size'] != FIT_FONT_SIZE:
+        context.update(margins(context, context['font_size']))
+
+    return context
+
+def margins(context, font_size):
+    """
+    Return the margins of a context in pixels for the given font size
+    """
+    return {margin: int(font_size * (context[margin] / 100.)) for margin in MARGINS}
+
+def check_parameters(context):
+    """
+    Check the values of a parsed context that can't be rendered or printed
+    """
+    if context['copies'] < 1 or context['copies'] > 20:
+        raise ValueError("The number of copies is limited to 20.")
+
+    if context['font_size'] != FIT_FONT_SIZE and \
+            not 1 <= context['font_size'] <= MAX_FONT_SIZE:
+        raise ValueError("The font size has to be between 1 and {}.".format(MAX_FONT_SIZE))
+
+    if not 0 <= context['font_index'] < len(FONTS):
+        raise LookupError("Couln't find the font with index {}"\
+                .format(context['font_index']))
+
+    if context['label_size'] != 'auto' and \
+            context['label_size'] not in LABELS_BY_IDENTIFIER:
+        raise LookupError("Unknown label_size: {}".format(context['label_size']))
+
+    if context['orientation'] not in ('portrait', 'landscape'):
+        raise ValueError("Invalid value for parameter 'orientation'. Must " +\
+                         "be one of 'portrait' or 'landscape'.")
+
+    if context['align'] not in text_layout.ALIGNMENTS:
+        raise ValueError("Invalid value for parameter 'align'. Must be one " +\
+                         "of 'left', 'center', 'right' or 'justify'.")
+
+    if context['align_vertical'] not in ('top', 'center', 'bottom'):
+        raise ValueError("Invalid value for parameter 'align_vertical'. Must " +\
+                         "be one of 'top', 'center' or 'bottom'.")
 
-    for margin in ('margin_top', 'margin_bottom', 'margin_left', 'margin_right'):
-        context[margin] = int(context['font_size'] * (context[margin] / 100.))
+    if not 0 <= context['threshold'] <= 100:
+        raise ValueError("The threshold has to be between 0 and 100.")
+
+def normalize_text(text):
+    """
+    Replace empty lines with a space, working around a bug in
+    multiline_textsize() when there are empty lines in the text. Doing
+    this before the text is measured keeps the cached measurements the
+    same as the printed lines.
+    """
+    return '\n'.join(line or ' ' for line in text.split('\n'))
+
+def render_image(data, block = False, submitted = None):
+    """
+    Common function to render a label for preview and printing
+
+    data is a mapping of parameters, usually the UTF-8 decoded form data.
+    The drawing runs on the render pool, which raises PoolBusy if it is
+    overloaded, unless block is set to wait for a free worker. submitted is
+    called with the future of the drawing, cancelling it raises
+    CancelledError.
+    """
+    start = time.perf_counter()
+
+    context = parse_parameters(data)
+    check_parameters(context)
+    context['text'] = normalize_text(context['text'])
 
     if context['label_size'] == 'auto':
-        if not printer:
-            with PrinterDevice(DEVICE) as printer_instance:
-                label = printer_instance.info()[1]
-        else:
-            label = printer.info()[1]
+        label = PRINTERS.get(data.get('printer')).monitor.info()[1]
         if not label:
             context['image'] = PIL.Image.new('L', (1, 1), 'white')
             return context
         context['label_size'] = label.identifier
     else:
-        for label_item in brother_ql.labels.ALL_LABELS:
-            if label_item.identifier == context['label_size']:
-                label = label_item
-                break
-        else: # no label did match
-            raise LookupError("Unknown label_size: {}".format(context['label_size']))
+        label = LABELS_BY_IDENTIFIER[context['label_size']]
 
-    if context['copies'] < 1 or context['copies'] > 20:
-        raise ValueError("The number of copies is limited to 20.")
+    if context['font_size'] == FIT_FONT_SIZE:
+        fit_font_size(context, label)
 
-    try:
-        font_path = FONTS[context['font_index']][0]
-    except KeyError:
-        raise LookupError("Couln't find the font with index {}"\
-                .format(context['font_index']))
+    context['key'] = render_key(context)
 
-    im_font = PIL.ImageFont.truetype(font_path, context['font_size'])
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage='parse')
 
-    image = PIL.Image.new('L', (20, 20), 'white')
-    draw = PIL.ImageDraw.Draw(image)
+    return render_context(context, label, block, submitted)
+
+def render_context(context, label, block=False, submitted=None, line_metrics=None):
+    """
+    Look up the image of a parsed context with its key in the render cache
+    or draw it, see render_image()
+    """
+    entry = RENDER_CACHE.get(context['key'])
+    if entry is None:
+        future = RENDER_POOL.submit(draw_label, context, label, line_metrics, block=block)
+        if submitted is not None:
+            submitted(future)
+        entry = future.result()
+        RENDER_CACHE.put(context['key'], entry)
+
+    context['cache_entry'] = entry
+    context['image'] = entry['image']
+    context['rotate'] = entry['rotate']
+
+    return context
 
-    # workaround for a bug in multiline_textsize()
-    # when there are empty lines in the text:
-    lines = []
-    for line in context['text'].split('\n'):
-        lines.append(line or ' ')
-    text = '\n'.join(lines)
+def render_template(template, values, block=False):
+    """
+    Render a label template with the values of its placeholders. The
+    parameters were parsed when the template was loaded, only the text
+    changes.
+    """
+    context = dict(template.context, text=normalize_text(template.fill(values)))
+    if 'copies' in values:
+        context['copies'] = int(values['copies'])
+        check_parameters(context)
+    if context['font_size'] == FIT_FONT_SIZE:
+        fit_font_size(context, template.label)
+    context['key'] = render_key(context)
+    return render_context(context, template.label, block, line_metrics=template.metrics)
+
+def init_render_worker(fonts, font_cache_size, strip_memory, measure_size):
+    """
+    Set up the globals used by draw_label in a render worker process
+    """
+    global FONTS, FONT_CACHE, STRIP_CACHE, MEASURE_CACHE
+    FONTS = fonts
+    FONT_CACHE = LRUCache(font_cache_size)
+    STRIP_CACHE = LRUCache(strip_memory, weigh=STRIP_CACHE.weigh)
+    MEASURE_CACHE = LRUCache(measure_size)
+
+def measure_text(context, im_font, line_metrics=None):
+    """
+    Return the layout of the text of a context as returned by
+    text_layout.layout(), laying it out only if it isn't cached already
+    """
+    key = (FONTS[context['font_index']][0], context['font_size'], context['align'],
+           context['text'])
+    return MEASURE_CACHE.get_or_create(key,
+            lambda: text_layout.layout(im_font, context['text'].split('\n'),
+                                       context['align'], line_metrics))
+
+def line_strip(context, im_font, text):
+    """
+    Return the mask of a single line of text as returned by
+    text_layout.draw_strip(), drawing it only if it isn't cached already
+    """
+    key = (FONTS[context['font_index']][0], context['font_size'], text)
+    return STRIP_CACHE.get_or_create(key,
+            lambda: text_layout.draw_strip(im_font, text))
+
+def fit_font_size(context, label):
+    """
+    Set the font size of a context to the largest one at which its text
+    fits onto the label within the margins, which grow with the font size.
+    On endless labels only the width of the tape limits the text. The
+    size is found by a binary search over the measured layouts, which are
+    kept for drawing the text at the chosen size, without drawing it.
+    """
+    (width, height) = label.dots_printable
+    if context['orientation'] == 'landscape':
+        (width, height) = (height, width)
+    if label.form_factor in ENDLESS_LABELS:
+        if context['orientation'] == 'landscape':
+            width = None
+        else:
+            height = None
+
+    def fits(font_size):
+        sized = dict(context, font_size=font_size, **margins(context, font_size))
+        (pieces, bbox) = measure_text(sized, load_font(context['font_index'], font_size))
+        return (width is None or math.ceil(bbox[2] - bbox[0]) <=
+                    width - sized['margin_left'] - sized['margin_right']) and \
+               (height is None or math.ceil(bbox[3] - bbox[1]) <=
+                    height - sized['margin_top'] - sized['margin_bottom'])
+
+    with STAGE_SECONDS.time(stage='fit'):
+        # the text and the margins grow about linearly with the font size,
+        # so the search starts around the size estimated from one layout
+        reference = 100
+        (pieces, bbox) = measure_text(dict(context, font_size=reference),
+                                      load_font(context['font_index'], reference))
+        estimates = [MAX_FONT_SIZE]
+        if width is not None:
+            estimates.append(width * reference / max(1, bbox[2] - bbox[0] +
+                    context['margin_left'] + context['margin_right']))
+        if height is not None:
+            estimates.append(height * reference / max(1, bbox[3] - bbox[1] +
+                    context['margin_top'] + context['margin_bottom']))
+        estimate = min(estimates)
+
+        # fits(low) and not fits(high) hold throughout the search
+        (low, high) = (1, MAX_FONT_SIZE + 1)
+        if not fits(low):
+            raise ValueError("The text doesn't fit onto the label at any font size.")
+        if estimate * .9 > low and fits(int(estimate * .9)):
+            low = int(estimate * .9)
+        if estimate * 1.1 < high and not fits(math.ceil(estimate * 1.1)):
+            high = math.ceil(estimate * 1.1)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if fits(middle):
+                low = middle
+            else:
+                high = middle
+
+    context['font_size'] = low
+    context.update(margins(context, low))
+
+def draw_label(context, label, line_metrics=None):
+    """
+    Draw the text of a parsed context onto a new image for the given label.
+    line_metrics are the measured lines of a template, see
+    text_layout.layout().
 
-    bbox = draw.multiline_textbbox((0, 0), text, font=im_font, align=context['align'])
+    returns: dict with the image, the rotation for the conversion and an
+             empty slot for the encoded PNG
+    """
+    with STAGE_SECONDS.time(stage='font_load'):
+        im_font = load_font(context['font_index'], context['font_size'])
+
+    # long texts on endless labels are composed from cached bitmaps of
+    # single lines, so changing a line only draws that line again
+    endless = label.form_factor in ENDLESS_LABELS
+
+    with STAGE_SECONDS.time(stage='measure'):
+        # gives the same bbox as multiline_textbbox()
+        (pieces, bbox) = measure_text(context, im_font, line_metrics)
     text_width, text_height = math.ceil(bbox[2] - bbox[0]), math.ceil(bbox[3] - bbox[1])
     # move anchor to make image start in the top right corner, and add margins
     horizontal_offset = -bbox[0] + context['margin_left']
@@ -208,20 +528,68 @@ def render_image(request, printer = None):
     elif context['align_vertical'] != 'top':
         vertical_offset += vertical_space_remaining // 2
 
-    context['image'] = PIL.Image.new('L', (width, height), 'white')
-    draw = PIL.ImageDraw.Draw(context['image'])
-    draw.multiline_text((horizontal_offset, vertical_offset), text, (0), \
-                        font=im_font, align=context['align'])
+    with STAGE_SECONDS.time(stage='draw'):
+        image = PIL.Image.new('L', (width, height), 'white')
+        if endless:
+            text_layout.compose(image, pieces, (horizontal_offset, vertical_offset),
+                    lambda text: line_strip(context, im_font, text))
+        else:
+            text_layout.draw(image, pieces, (horizontal_offset, vertical_offset), im_font)
 
-    if label.form_factor in ENDLESS_LABELS:
+    if endless:
         if context['orientation'] == 'portrait':
-            context['rotate'] = 0
+            rotate = 0
         else:
-            context['rotate'] = 90
+            rotate = 90
     else:
-        context['rotate'] = 'auto'
+        rotate = 'auto'
 
-    return context
+    return {'image': image, 'rotate': rotate, 'encoded': {}}
+
+def apply_threshold(image, threshold, mode='L'):
+    """
+    Reduce an image to black and white the same way the conversion does for
+    the given threshold, so it prints the same with any other threshold
+    """
+    cutoff = min(255, max(0, int((100.0 - threshold) / 100.0 * 255)))
+    return image.point(lambda x: 0 if 255 - x >= cutoff else 255, mode)
+
+PREVIEW_FORMATS = ('png', 'json', 'mono', 'thumbnail')
+
+def encode_preview(context, mono=False, width=None):
+    """
+    Return the image of a rendered context encoded as PNG, optionally
+    thresholded to 1 bit like the printed label and downscaled to the given
+    width. The result is stored in the render cache entry, so each variant
+    is only encoded once. The encoded variants of an entry are replaced
+    rather than changed, as other threads may be weighing them.
+    """
+    variant = (context['threshold'] if mono else None, width)
+
+    entry = context.get('cache_entry')
+    if entry is not None:
+        png = entry['encoded'].get(variant)
+        if png is not None:
+            return png
+
+    with STAGE_SECONDS.time(stage='png_encode'):
+        image = context['image']
+        if mono:
+            image = apply_threshold(image, context['threshold'], '1')
+        if width and width < image.width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.convert('L').resize((width, height), PIL.Image.Resampling.BOX)
+
+        image_buffer = io.BytesIO()
+        image.save(image_buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+        png = image_buffer.getvalue()
+
+    if entry is not None:
+        entry['encoded'] = {**entry['encoded'], variant: png}
+        # store again so the cache accounts for the size of the PNG
+        RENDER_CACHE.put(context['key'], entry)
+
+    return png
 
 @bottle.route('/api/text/preview', method=['GET', 'POST'])
 @exception_to_json
@@ -230,7 +598,8 @@ def api_text_preview():
     API to generate a preview image
 
     parameters: text:str             Label text
-                font_size:int        Font size in points
+                font_size:int        Font size in points, or "fit" for the
+                                     largest size at which the text fits
                 font_index:int       Font index as returned by /api/config
                 label_size:str       Label size as returned by /api/config
                 threshold:int        Threshold for black and white conversion
@@ -242,32 +611,389 @@ def api_text_preview():
                 margin_bottom:float  Text margin in pixels
                 margin_left:float    Text margin in pixels
                 margin_right:float   Text margin in pixels
-                return_format:str    "png" or "json"
+                return_format:str    "png" (8 bit greyscale), "json" (the
+                                     same PNG base64 encoded), "mono" (1 bit
+                                     PNG thresholded like the printout) or
+                                     "thumbnail" (mono PNG downscaled to width)
+                width:int            Width of the thumbnail in pixels
+
+    returns: PNG or JSON depending on return_format parameter. The size of
+             the label in pixels is given by the X-Label-Width and
+             X-Label-Height headers or the width and height fields in JSON,
+             the font size used by the X-Font-Size header or the font_size
+             field.
+    """
+    return preview_response(lambda: render_image(bottle.request.params.decode()))
 
-    returns: PNG or JSON depending on return_format parameter
+def preview_response(render):
+    """
+    Respond with the preview of the context returned by render() in the
+    return_format given by the query
     """
     return_format = bottle.request.query.get('return_format', 'png')
+    if return_format not in PREVIEW_FORMATS:
+        return {
+            'success': False,
+            'messages': ['Value for return_format not recognised. Must be one of "{}"'
+                         .format('", "'.join(PREVIEW_FORMATS))],
+            }
+
+    mono = return_format in ('mono', 'thumbnail')
+    width = None
+    if return_format == 'thumbnail':
+        width = max(1, int(bottle.request.query.get('width', 400)))
 
-    context = render_image(bottle.request)
+    context = render()
 
-    image_buffer = io.BytesIO()
+    (label_width, label_height) = context['image'].size
+    bottle.response.set_header('X-Label-Width', str(label_width))
+    bottle.response.set_header('X-Label-Height', str(label_height))
+    bottle.response.set_header('X-Font-Size', str(context['font_size']))
 
-    context['image'].save(image_buffer, format="PNG")
+    if 'key' in context:
+        variant = (return_format, context['threshold'] if mono else None, width)
+        digest = hashlib.sha256(repr((context['key'], variant)).encode()).hexdigest()
+        etag = '"{}"'.format(digest[:32])
+        bottle.response.set_header('ETag', etag)
+        if etag in bottle.request.get_header('If-None-Match', ''):
+            bottle.response.status = 304
+            return b''
 
-    image_buffer.seek(0)
+    png = encode_preview(context, mono, width)
 
     if return_format == 'json':
         return {
             'success': True,
-            'image': base64.b64encode(image_buffer.read()).decode('utf-8'),
+            'image': base64.b64encode(png).decode('utf-8'),
+            'width': label_width,
+            'height': label_height,
+            'font_size': context['font_size'],
             }
-    if return_format == 'png':
-        bottle.response.set_header('Content-type', 'image/png')
-        return image_buffer.read()
 
+    bottle.response.set_header('Content-type', 'image/png')
+    return png
+
+def preview_event(session, generation, params):
+    """
+    Render the parameters pushed to a preview session as a thumbnail
+
+    returns: dict for the event, None if newer parameters arrived meanwhile
+    """
+    params = dict(params)
+    try:
+        width = max(1, int(params.pop('width', 400)))
+        context = render_image(params, block=True,
+                               submitted=session.submitted(generation))
+        if session.superseded(generation):
+            PREVIEWS_SUPERSEDED.inc(stage='encode')
+            return None
+        png = encode_preview(context, True, width)
+    except concurrent.futures.CancelledError:
+        PREVIEWS_SUPERSEDED.inc(stage='render')
+        return None
+    except Exception as e:
+        LOGGER.info('Streamed preview failed: %r', e)
+        return {'success': False, 'messages': error_messages(e)}
+
+    if session.superseded(generation):
+        PREVIEWS_SUPERSEDED.inc(stage='send')
+        return None
+
+    (label_width, label_height) = context['image'].size
+    return {
+        'success': True,
+        'image': base64.b64encode(png).decode('utf-8'),
+        'width': label_width,
+        'height': label_height,
+        'font_size': context['font_size'],
+        }
+
+def preview_events(session):
+    """
+    Generate the Server-Sent Events of a preview stream, releasing the slot
+    reserved for it when it ends
+    """
+    try:
+        stream = session.open_stream()
+        try:
+            yield 'retry: 1000\n\n'
+            generation = 0
+            while session.is_current(stream):
+                (new_generation, params) = session.wait(stream, generation, PREVIEW_KEEPALIVE)
+                if new_generation is None:
+                    # lets the server notice clients that went away
+                    yield ': keepalive\n\n'
+                    continue
+                generation = new_generation
+                event = preview_event(session, generation, params)
+                if event is not None:
+                    yield 'data: {}\n\n'.format(json.dumps(event))
+        finally:
+            session.close_stream(stream)
+    finally:
+        PREVIEW_SESSIONS.release_stream()
+
+@bottle.route('/api/text/preview/stream/<session_id>', method='GET')
+def api_preview_stream(session_id):
+    """
+    Stream of preview thumbnails as Server-Sent Events for the parameters
+    pushed to the same session id. The stream stays open, a new stream for
+    the session closes the previous one. If too many streams are open, the
+    client has to fall back to /api/text/preview.
+
+    returns: Events with JSON data like /api/text/preview with
+             return_format=json, for the latest parameters only
+    """
+    if not PREVIEW_STREAM:
+        bottle.abort(404, 'Streamed previews are disabled.')
+    if not PREVIEW_SESSIONS.reserve_stream():
+        bottle.abort(503, 'Too many open preview streams.')
+    bottle.response.set_header('Content-type', 'text/event-stream')
+    bottle.response.set_header('Cache-Control', 'no-cache')
+    return preview_events(PREVIEW_SESSIONS.get(session_id))
+
+@bottle.route('/api/text/preview/stream/<session_id>', method='POST')
+@exception_to_json
+def api_preview_update(session_id):
+    """
+    API to push new parameters to a preview stream
+
+    parameters: the parameters of /api/text/preview except return_format
+                width:int            Width of the thumbnail in pixels
+                seq:int              Increasing number of the update, older
+                                     updates arriving late are ignored
+
+    returns: JSON, the preview is sent on the stream
+    """
+    if not PREVIEW_STREAM:
+        return {'success': False, 'messages': ['Streamed previews are disabled.']}
+    params = dict(bottle.request.params.decode())
+    sequence = params.pop('seq', None)
+    try:
+        int(params.get('width', 400))
+    except ValueError:
+        return {'success': False, 'messages': [
+            "Invalid value for parameter 'width': {!r}".format(params['width'])]}
+    PREVIEW_SESSIONS.get(session_id).update(
+        params, int(sequence) if sequence is not None else None)
+    return {'success': True}
+
+def new_raster(model):
+    """
+    Create a BrotherQLRaster for conversion of labels
+    """
+    qlr = brother_ql.raster.BrotherQLRaster(model.identifier)
+
+    # convert will call add_status_information which we don't need
+    # overriding this, so it has no effect
+    qlr.add_status_information = lambda: None
+
+    return qlr
+
+def raster_preamble(model):
+    """
+    Return the commands convert() sends ahead of the first page, they only
+    depend on the model
+    """
+    def create():
+        qlr = new_raster(model)
+        brother_ql.conversion.convert(qlr=qlr, images=[], label='62')
+        return qlr.data
+    return RASTER_CACHE.get_or_create(('preamble', model.identifier), create)
+
+def raster_page(context, model, label, cut=True):
+    """
+    Return the raster data of a single page for a rendered context. Every
+    page produced by convert() is self-contained, so the pages of several
+    labels and copies can be concatenated after the preamble.
+    """
+    key = (context['key'], model.identifier, label.identifier,
+           context['threshold'], context['rotate'], cut)
+
+    def create():
+        qlr = new_raster(model)
+        with STAGE_SECONDS.time(stage='convert'):
+            if convert_page(qlr, context['image'], label, model, context['threshold'],
+                            context['rotate'], cut, label.form_factor in ENDLESS_LABELS):
+                return qlr.data
+            brother_ql.conversion.convert(
+                qlr=qlr,
+                images=[context['image']],
+                label=label.identifier,
+                threshold=context['threshold'],
+                cut=cut,
+                rotate=context['rotate'],
+                )
+        preamble = raster_preamble(model)
+        if not qlr.data.startswith(preamble):
+            raise RuntimeError("Raster data of {} doesn't start with the expected "
+                               "preamble".format(model.identifier))
+        return qlr.data[len(preamble):]
+    return RASTER_CACHE.get_or_create(key, create)
+
+def job_printer_info(device):
+    """
+    Return the tuple (model, label) of the printer of a job from its cached
+    status, only asking the printer if the status is outdated
+    """
+    (status, info, error) = PRINTERS.get(device).monitor.cached()
+    if info is not None:
+        return info
+    with PrinterDevice(device) as printer:
+        return printer.info()
+
+def raster_job(context, model, label):
+    """
+    Check that the label of a rendered context is loaded and return the
+    raster data to print it
+    """
+    if not label:
+        raise JobError("No label in printer.")
+
+    if label.identifier != context['label_size']:
+        raise JobError("Wrong label size.")
+
+    return raster_preamble(model) + \
+            raster_page(context, model, label) * context['copies']
+
+def print_label(job, render=None):
+    """
+    Render and print the label of a queued job. render is called with the
+    loaded label and returns the rendered context, by default the
+    parameters of the job are rendered. The label is rendered before the
+    printer is opened, so status queries don't wait for the rendering.
+    """
+    job.set_state('rendering')
+
+    info = job_printer_info(job.device)
+    (model, label) = info
+
+    if render is not None:
+        context = render(label)
+    elif job.params.get('label_size', DEFAULTS['label_size']) == 'auto':
+        if not label:
+            raise JobError("No label in printer.")
+        context = render_image(dict(job.params, label_size=label.identifier), block=True)
+    else:
+        context = render_image(job.params, block=True)
+
+    try:
+        data = raster_job(context, model, label)
+    except JobError:
+        # checked again against the printer below
+        data = None
+
+    with PrinterDevice(job.device) as printer:
+        current = printer.info()
+        if data is None or current != info:
+            data = raster_job(context, *current)
+
+        job.set_state('printing')
+
+        printer.print(data, context['copies'])
+
+def preflight(context, device=None):
+    """
+    Check a parsed job before it is queued, also against the cached status
+    of the printer it would go to, so jobs that can only fail are rejected
+    without waiting for the printer or talking to it
+
+    raises: ValueError, LookupError or JobError with the reason, or the
+            PrinterError of the cached status
+    """
+    check_parameters(context)
+
+    printers = PRINTERS.candidates(context['label_size'], device)
+    if len(printers) != 1:
+        # all of them have the label loaded
+        return
+
+    (status, info, error) = printers[0].monitor.cached()
+    if isinstance(error, PrinterError):
+        raise error
+    if info is None:
+        # unknown or failed to connect, leave it to the job
+        return
+
+    label = info[1]
+    if not label:
+        raise JobError("No label in printer.")
+    if context['label_size'] not in ('auto', label.identifier):
+        raise JobError("Wrong label size.")
+
+def print_batch(job):
+    """
+    Render the labels of a queued batch job in parallel and print them as
+    a single raster stream. The labels are rendered for the label in the
+    cached status before the printer is opened.
+    """
+    job.set_state('rendering')
+
+    info = job_printer_info(job.device)
+    (model, label) = info
+
+    if not label:
+        raise JobError("No label in printer.")
+
+    def render_item(item):
+        params = job.params[item['index']]
+        try:
+            if params.get('label_size', DEFAULTS['label_size']) == 'auto':
+                params = dict(params, label_size=label.identifier)
+            context = render_image(params, block=True)
+            if context['label_size'] != label.identifier:
+                raise JobError("Wrong label size.")
+            page = raster_page(context, model, label)
+        except Exception as e:
+            item['state'] = 'failed'
+            item['messages'] = error_messages(e)
+            return []
+        item['state'] = 'rendered'
+        return [page] * context['copies']
+
+    # the threads mostly wait for the render pool, which does the drawing
+    with concurrent.futures.ThreadPoolExecutor(RENDER_POOL.workers) as executor:
+        rendered = list(executor.map(render_item, job.items))
+
+    # the item each page belongs to, in the order they are printed
+    page_items = [item for (item, pages) in zip(job.items, rendered) for _ in pages]
+    if not page_items:
+        raise JobError("None of the labels could be rendered.")
+
+    def page_done(index):
+        # an item is done with the last of its copies
+        if index + 1 >= len(page_items) or page_items[index + 1] is not page_items[index]:
+            page_items[index]['state'] = 'done'
+
+    data = raster_preamble(model) + b''.join(page for pages in rendered for page in pages)
+
+    with PrinterDevice(job.device) as printer:
+        if printer.info() != info:
+            raise JobError("The label in the printer changed while rendering.")
+
+        job.set_state('printing')
+
+        try:
+            printer.print(data, len(page_items), page_done)
+        except Exception as e:
+            for item in job.items:
+                if item['state'] == 'rendered':
+                    item['state'] = 'failed'
+                    item['messages'] = error_messages(e)
+            raise
+
+def wait_response(job):
+    """
+    Wait up to WAIT_TIMEOUT seconds for a job to finish, so a job waiting
+    in the spool doesn't hold a worker of the server, and respond with its
+    state
+    """
+    job.finished.wait(WAIT_TIMEOUT)
     return {
-        'success': False,
-        'messages': ['Value for return_format not recognised. Must be one of "png" or "json"'],
+        'success': job.state == 'done',
+        'job_id': job.id,
+        'state': job.state,
+        'messages': job.messages,
         }
 
 @bottle.route('/api/text/print', method=['GET', 'POST'])
@@ -277,7 +1003,8 @@ def api_text_print():
     API to send a print job
 
     parameters: text:str             Label text
-                font_size:int        Font size in points
+                font_size:int        Font size in points, or "fit" for the
+                                     largest size at which the text fits
                 font_index:int       Font index as returned by /api/config
                 label_size:str       Label size as returned by /api/config
                 threshold:int        Threshold for black and white conversion
@@ -289,39 +1016,364 @@ def api_text_print():
                 margin_bottom:float  Text margin in pixels
                 margin_left:float    Text margin in pixels
                 margin_right:float   Text margin in pixels
+                printer:str          Printer to use as returned by
+                                     /api/printers (default: any printer
+                                     with the requested label loaded)
+                wait:bool            Wait up to 30 seconds for the job to
+                                     finish before returning (default: false)
+
+    returns: JSON with the job id, and its state if wait is set.
+             Invalid jobs and jobs the printer can't print according to
+             its cached status are rejected without queueing them. With
+             the spool enabled, the label is rendered right away and kept
+             in the spool until the printer is ready instead.
+    """
+    params = dict(bottle.request.params.decode())
+    wait = params.pop('wait', 'false').lower() in ('1', 'true')
+    device = params.pop('printer', None)
 
-    returns: JSON
+    try:
+        context = parse_parameters(params)
+        if SPOOL is not None:
+            check_parameters(context)
+            job = spool_label(lambda label: render_image(
+                                  dict(params, label_size=label.identifier)),
+                              context['label_size'], device)
+        else:
+            preflight(context, device)
+            job = PRINTERS.submit(params, label_size=context['label_size'], device=device)
+    except (ValueError, LookupError, JobError) as e:
+        return {'success': False, 'messages': [str(e)]}
+
+    if not wait:
+        return {'success': True, 'job_id': job.id}
+
+    return wait_response(job)
+
+@bottle.route('/api/batch/print', method='POST')
+@exception_to_json
+def api_batch_print():
     """
-    with PrinterDevice(DEVICE) as printer:
-        context = render_image(bottle.request, printer)
+    API to print many different labels as one print job
 
-        (model, label) = printer.info()
+    parameters: A JSON list of objects (or an object with such a list as
+                "labels") with the same parameters as /api/text/print, or
+                CSV with these parameters as column names in the first row.
+                Query parameters are used as defaults for all labels.
+                The batch goes to the printer given by the printer query
+                parameter or to one with the label of the first label loaded.
 
-        if not label:
-            return {'success': False, 'messages': ["No label in printer."]}
+    returns: JSON with the job id, /api/jobs/<id> reports the state of each
+             label as "items"
+    """
+    defaults = dict(bottle.request.query.decode())
+    device = defaults.pop('printer', None)
+
+    if bottle.request.content_type.startswith('text/csv'):
+        body = bottle.request.body.read().decode('utf-8-sig')
+        labels = list(csv.DictReader(io.StringIO(body)))
+    else:
+        try:
+            labels = json.loads(bottle.request.body.read().decode('utf-8'))
+        except ValueError:
+            labels = None
+        if isinstance(labels, dict):
+            labels = labels.get('labels')
+
+    if not isinstance(labels, list) or \
+            not all(isinstance(params, dict) for params in labels):
+        return {'success': False, 'messages': ["Expected a list of labels."]}
+
+    if not labels:
+        return {'success': False, 'messages': ["No labels given."]}
+
+    if len(labels) > MAX_BATCH_SIZE:
+        return {'success': False, 'messages': [
+            "The number of labels is limited to {}.".format(MAX_BATCH_SIZE)]}
+
+    params_list = []
+    messages = []
+    for index, params in enumerate(labels):
+        # empty or missing CSV cells fall back to the defaults
+        params = {name: value for name, value in params.items()
+                  if value is not None and value != ''}
+        params = dict(defaults, **params)
+        params_list.append(params)
+        try:
+            check_parameters(parse_parameters(params))
+        except (ValueError, LookupError) as e:
+            messages.append("Label {}: {}".format(index + 1, e))
+
+    if messages:
+        return {'success': False, 'messages': messages}
+
+    items = [{'index': index, 'state': 'queued', 'messages': []}
+             for index in range(len(labels))]
+
+    try:
+        preflight(parse_parameters(params_list[0]), device)
+        job = PRINTERS.submit(params_list, print_batch, items,
+                              params_list[0].get('label_size', DEFAULTS['label_size']),
+                              device)
+    except (ValueError, LookupError, JobError) as e:
+        return {'success': False, 'messages': [str(e)]}
+
+    return {'success': True, 'job_id': job.id}
+
+def print_template(job):
+    """
+    Render and print the label of a queued job for a template
+    """
+    template = LABEL_TEMPLATES[job.params['template']]
+    print_label(job, lambda label: render_template(template, job.params['values'],
+                                                   block=True))
+
+def spool_label(render, label_size='auto', device=None):
+    """
+    Render a label right away for the printer a job would go to and store
+    its raster data in the spool, from where it is printed once the printer
+    is ready. This only needs the model of the printer to be known, not
+    the printer to be reachable. Jobs for another label than the one last
+    seen in the printer are rejected, only a printer without labels is
+    waited for. render is called with the label and returns the rendered
+    context.
+
+    returns: the queued Job
+    """
+    try:
+        printer = min(PRINTERS.candidates(label_size, device),
+                      key=lambda printer: printer.queue.load())
+    except LookupError:
+        # none of them is ready, wait for the requested or default one
+        printer = PRINTERS.get(device)
 
-        if label.identifier != context['label_size']:
-            return {'success': False, 'messages': ["Wrong label size."]}
+    if printer.monitor.known_info is None:
+        try:
+            printer.monitor.refresh()
+        except Exception:
+            pass
+    if printer.monitor.known_info is None:
+        raise JobError("The model of the printer is unknown, it never answered.")
+    (model, label) = printer.monitor.known_info
+
+    if label_size != 'auto':
+        if label and label.identifier != label_size:
+            raise JobError("Wrong label size.")
+        label = LABELS_BY_IDENTIFIER[label_size]
+    elif not label:
+        raise JobError("No label in printer.")
+
+    context = render(label)
+    data = raster_preamble(model) + raster_page(context, model, label) * context['copies']
+
+    metadata = SPOOL.put(data, {
+        'device': printer.device,
+        'model': model.identifier,
+        'label_size': label.identifier,
+        'pages': context['copies'],
+        })
+    return printer.queue.submit(metadata, print_spooled)
 
-        qlr = brother_ql.raster.BrotherQLRaster(model.identifier)
+def remember_printer(device, known_info):
+    """
+    Keep the model and label last seen on a printer in the spool
+    """
+    (model, label) = known_info
+    SPOOL.set_printer(device, model.identifier, label.identifier if label else None)
 
-        # convert will call add_status_information which we don't need
-        # overriding this, so it has no effect
-        qlr.add_status_information = lambda: None
+def print_spooled(job):
+    """
+    Print the raster data of a spooled job if its printer reports that it
+    is ready, with the model and label the data was rendered for. Otherwise
+    the job is queued again to be tried after SPOOL_RETRY_INTERVAL, so the
+    jobs behind it aren't held up, and fails once it waited longer than
+    SPOOL_MAX_WAIT. The job is only removed from the spool once it was
+    printed or failed. A failed attempt is tried again, which may print a
+    label twice if it failed halfway.
+    """
+    if SPOOL_MAX_WAIT > 0 and time.time() - job.params['created'] > SPOOL_MAX_WAIT:
+        SPOOL.remove(job.params['id'])
+        raise JobError("The printer wasn't ready within {:g} seconds."
+                       .format(SPOOL_MAX_WAIT))
 
-        brother_ql.conversion.convert(
-            qlr=qlr,
-            images=[context['image']] * context['copies'],
-            label=label.identifier,
-            threshold=context['threshold'],
-            cut=True,
-            rotate=context['rotate'],
-            )
+    try:
+        data = SPOOL.read(job.params['id'])
+    except OSError:
+        SPOOL.remove(job.params['id'])
+        raise JobError("The spooled raster data is missing.")
 
-        printer.print(qlr)
+    try:
+        with PrinterDevice(job.device) as printer:
+            status = printer.status()
+            if status.errors:
+                messages = [error.description for error in status.errors]
+            elif status.phase_type != PhaseTypes.READY:
+                messages = ["Waiting for the printer to be ready."]
+            else:
+                (model, label) = status_info(status)
+                if model.identifier != job.params['model']:
+                    messages = ["Waiting for a {} printer.".format(job.params['model'])]
+                elif not label or label.identifier != job.params['label_size']:
+                    messages = ["Waiting for label {}.".format(job.params['label_size'])]
+                else:
+                    job.set_state('printing')
+                    printer.print(data, job.params.get('pages', 1))
+                    job.messages = []
+                    SPOOL.remove(job.params['id'])
+                    return
+    except Exception as e:
+        messages = error_messages(e)
+        LOGGER.debug('Spooled job %s not printed yet: %r', job.params['id'], e)
+
+    raise JobDeferred(SPOOL_RETRY_INTERVAL, messages)
+
+# parameters of the template endpoints, which can't be used as placeholders
+TEMPLATE_OPTIONS = ('copies', 'printer', 'wait', 'return_format', 'width')
+
+@bottle.route('/api/templates')
+@exception_to_json
+def api_templates():
+    """
+    API to list the label templates
+
+    parameter: none
+
+    returns: JSON with the name, the placeholders as "fields" and the label
+             size of each template
+    """
+    return {
+        'success': True,
+        'templates': [template.to_dict() for template in LABEL_TEMPLATES.values()],
+        }
+
+@bottle.route('/api/template/<name>/preview', method=['GET', 'POST'])
+@exception_to_json
+def api_template_preview(name):
+    """
+    API to generate a preview image of a template
+
+    parameters: the values of the placeholders of the template
+                copies:int           Number of copies to print
+                return_format:str    See /api/text/preview
+                width:int            Width of the thumbnail in pixels
+
+    returns: PNG or JSON like /api/text/preview
+    """
+    template = LABEL_TEMPLATES.get(name)
+    if template is None:
+        return {'success': False, 'messages': ["Unknown template."]}
+    values = bottle.request.params.decode()
+    return preview_response(lambda: render_template(template, values))
+
+@bottle.route('/api/template/<name>/print', method=['GET', 'POST'])
+@exception_to_json
+def api_template_print(name):
+    """
+    API to send a print job for a template
+
+    parameters: the values of the placeholders of the template
+                copies:int           Number of copies to print
+                printer:str          Printer to use as returned by
+                                     /api/printers (default: any printer
+                                     with the label of the template loaded)
+                wait:bool            Wait up to 30 seconds for the job to
+                                     finish before returning (default: false)
+
+    returns: JSON with the job id, and its state if wait is set
+    """
+    template = LABEL_TEMPLATES.get(name)
+    if template is None:
+        return {'success': False, 'messages': ["Unknown template."]}
+    values = dict(bottle.request.params.decode())
+    wait = values.pop('wait', 'false').lower() in ('1', 'true')
+    device = values.pop('printer', None)
+
+    try:
+        template.fill(values)
+        context = dict(template.context)
+        if 'copies' in values:
+            context['copies'] = int(values['copies'])
+        if SPOOL is not None:
+            check_parameters(context)
+            job = spool_label(lambda label: render_template(template, values),
+                              template.label.identifier, device)
+        else:
+            preflight(context, device)
+            job = PRINTERS.submit({'template': name, 'values': values}, print_template,
+                                  label_size=template.label.identifier, device=device)
+    except (ValueError, LookupError, JobError) as e:
+        return {'success': False, 'messages': [str(e)]}
+
+    if not wait:
+        return {'success': True, 'job_id': job.id}
+
+    return wait_response(job)
+
+@bottle.route('/api/jobs/<job_id>')
+@exception_to_json
+def api_job(job_id):
+    """
+    API to query the state of a print job
+
+    parameter: none
+
+    returns: JSON with the job state ("queued", "rendering", "printing",
+             "done" or "failed"), error messages and the seconds spent in
+             each state
+    """
+    job = PRINTERS.get_job(job_id)
+    if job is None:
+        return {'success': False, 'messages': ["Unknown job."]}
+
+    return {
+        'success': True,
+        'job': job.to_dict(),
+        'queue_depth': PRINTERS.get(job.device).queue.depth(),
+        }
+
+@bottle.route('/api/jobs/<job_id>/cancel', method='POST')
+@exception_to_json
+def api_job_cancel(job_id):
+    """
+    API to cancel a print job that is still queued, like one waiting in the
+    spool for its printer
+
+    parameter: none
+
+    returns: JSON, success is false if the job already started or finished
+    """
+    job = PRINTERS.get_job(job_id)
+    if job is None:
+        return {'success': False, 'messages': ["Unknown job."]}
+
+    if not PRINTERS.get(job.device).queue.cancel(job):
+        return {'success': False, 'messages': [
+            "The job is {} and can't be cancelled.".format(job.state)]}
+
+    if job.handler is print_spooled:
+        SPOOL.remove(job.params['id'])
 
     return {'success': True}
 
+def config_response():
+    """
+    Serialize the response of /api/config, which doesn't change after the
+    startup
+
+    returns: tuple (body, gzip compressed body, etag)
+    """
+    body = json.dumps({
+        'success': True,
+        'fonts': group_by_family(FONTS),
+        'label_sizes': [(label.identifier, label.name) for label in LABELS],
+        'default_values': dict(DEFAULTS),
+        'preview_stream': PREVIEW_STREAM,
+        }, separators=(',', ':')).encode('utf-8')
+    etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+    return (body, gzip.compress(body, mtime=0), etag)
+
+CONFIG_RESPONSE = None
+
 @bottle.route('/api/config')
 @exception_to_json
 def api_config():
@@ -330,27 +1382,110 @@ def api_config():
 
     parameter: none
 
+    returns: JSON, fonts are grouped by family as
+             [[family, [[font_index, style], ...]], ...]
+    """
+    global CONFIG_RESPONSE
+    if CONFIG_RESPONSE is None:
+        CONFIG_RESPONSE = config_response()
+    (body, compressed_body, etag) = CONFIG_RESPONSE
+
+    bottle.response.set_header('ETag', etag)
+    bottle.response.set_header('Cache-Control', 'no-cache')
+    bottle.response.set_header('Vary', 'Accept-Encoding')
+    if etag in bottle.request.get_header('If-None-Match', ''):
+        bottle.response.status = 304
+        return b''
+
+    bottle.response.set_header('Content-type', 'application/json')
+    if 'gzip' in bottle.request.get_header('Accept-Encoding', ''):
+        bottle.response.set_header('Content-Encoding', 'gzip')
+        return compressed_body
+    return body
+
+@bottle.route('/api/stats')
+@exception_to_json
+def api_stats():
+    """
+    API to query internal counters (cache sizes, hits and misses, queue
+    depths)
+
+    parameter: none
+
     returns: JSON
     """
     return {
         'success': True,
-        'fonts': [(index, font[1], font[2]) for index, font in enumerate(FONTS)],
-        'label_sizes': [(label.identifier, label.name) for label in brother_ql.labels.ALL_LABELS],
-        'default_values': dict(DEFAULTS),
+        'font_cache': FONT_CACHE.stats(),
+        'render_cache': RENDER_CACHE.stats(),
+        'raster_cache': RASTER_CACHE.stats(),
+        'strip_cache': STRIP_CACHE.stats(),
+        'measure_cache': MEASURE_CACHE.stats(),
+        'print_queues': {printer.device: printer.queue.stats() for printer in PRINTERS},
+        'render_pool': RENDER_POOL.stats(),
+        'spool': len(SPOOL) if SPOOL is not None else None,
         }
 
+def cache_metrics(field):
+    return lambda: [({'cache': name}, cache.stats()[field]) for name, cache in
+                    (('font', FONT_CACHE), ('render', RENDER_CACHE), ('raster', RASTER_CACHE),
+                     ('strip', STRIP_CACHE), ('measure', MEASURE_CACHE))]
+
+def register_metrics():
+    """
+    Register the metrics read from the caches, queues and pools. This is
+    done by main() rather than on import, so they read the state of the
+    module that runs the service, also when it runs as __main__.
+    """
+    metrics.Callback('printui_cache_hits_total', 'Cache hits', 'counter',
+                     cache_metrics('hits'))
+    metrics.Callback('printui_cache_misses_total', 'Cache misses', 'counter',
+                     cache_metrics('misses'))
+    metrics.Callback('printui_cache_weight', 'Size of the cached entries (bytes for '
+                     'render, raster and strip, entries for font and measure)', 'gauge', cache_metrics('weight'))
+    metrics.Callback('printui_print_queue_depth', 'Print jobs waiting in the queue', 'gauge',
+                     lambda: [({'printer': printer.device}, printer.queue.depth())
+                              for printer in PRINTERS])
+    metrics.Callback('printui_print_jobs_total', 'Print jobs processed', 'counter',
+                     lambda: [({'printer': printer.device}, printer.queue.processed)
+                              for printer in PRINTERS])
+    metrics.Callback('printui_print_jobs_failed_total', 'Print jobs failed', 'counter',
+                     lambda: [({'printer': printer.device}, printer.queue.failed)
+                              for printer in PRINTERS])
+    metrics.Callback('printui_render_pool_pending', 'Renders running or waiting for a '
+                     'worker', 'gauge', lambda: [({}, RENDER_POOL.pending())])
+    metrics.Callback('printui_render_pool_rejected_total', 'Renders rejected because '
+                     'the pool was busy', 'counter', lambda: [({}, RENDER_POOL.rejected)])
+    metrics.Callback('printui_spool_jobs', 'Print jobs in the spool', 'gauge',
+                     lambda: [({}, len(SPOOL) if SPOOL is not None else 0)])
+    metrics.Callback('printui_preview_sessions', 'Sessions of streamed previews', 'gauge',
+                     lambda: [({}, len(PREVIEW_SESSIONS))])
+
+@bottle.route('/metrics')
+def api_metrics():
+    """
+    Metrics in the Prometheus text format
+    """
+    bottle.response.set_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+    return metrics.expose()
+
 @bottle.route('/api/status')
 @exception_to_json
 def api_status():
     """
     API to query the printer status (label size, errors)
 
-    parameter: none
+    parameter: printer:str   Printer as returned by /api/printers
+                             (default: the first one)
+               refresh:bool  Query the printer instead of using the
+                             status cached for up to status_max_age seconds
 
     returns: JSON
     """
-    with PrinterDevice(DEVICE) as printer:
-        (model, label) = printer.info()
+    monitor = PRINTERS.get(bottle.request.query.get('printer')).monitor
+    if bottle.request.query.get('refresh', 'false').lower() in ('1', 'true'):
+        monitor.refresh()
+    (model, label) = monitor.info()
 
     return {
         'success': True,
@@ -358,8 +1493,100 @@ def api_status():
         'label': label.identifier if label else None,
         }
 
+@bottle.route('/api/status/history')
+@exception_to_json
+def api_status_history():
+    """
+    API to query the last status frames received from a printer, for
+    diagnosing it
+
+    parameter: printer:str   Printer as returned by /api/printers
+                             (default: the first one)
+
+    returns: JSON with the frames from the oldest on, each with the time it
+             was received, the raw frame in hex and the decoded type, phase
+             and errors
+    """
+    printer = PRINTERS.get(bottle.request.query.get('printer'))
+    history = CONNECTIONS.history(printer.device)
+    frames = history.snapshot() if history is not None else []
+
+    return {
+        'success': True,
+        'printer': printer.device,
+        'frames': [{
+            'time': received,
+            'frame': status.data.hex(),
+            'status_type': status.status_type.name,
+            'phase_type': status.phase_type.name,
+            'errors': [error.name for error in status.errors],
+            } for (received, status) in frames],
+        }
+
+@bottle.route('/api/printers')
+@exception_to_json
+def api_printers():
+    """
+    API to list all printers with their model, loaded label, errors and
+    print queue
+
+    parameter: refresh:bool  Query the printers instead of using their
+                             cached status
+
+    returns: JSON
+    """
+    if bottle.request.query.get('refresh', 'false').lower() in ('1', 'true'):
+        for printer in PRINTERS:
+            try:
+                printer.monitor.refresh()
+            except Exception:
+                pass
+
+    return {
+        'success': True,
+        'printers': [printer.to_dict() for printer in PRINTERS],
+        }
+
+def load_template(name, options, font_indexes):
+    """
+    Parse a template from the options of its configuration section, with
+    the defaults for missing parameters. The font is given by family and
+    style as "font = DejaVu Sans:Bold".
+    """
+    params = dict(DEFAULTS)
+    params.update(options)
+
+    if 'font' in options:
+        (family, style) = options['font'].split(':')
+        if (family, style) not in font_indexes:
+            raise LookupError("Couldn't find the font {}".format(options['font']))
+        params['font_index'] = font_indexes[(family, style)]
+
+    context = parse_parameters(params)
+
+    label = LABELS_BY_IDENTIFIER.get(context['label_size'])
+    if label is None:
+        raise LookupError("Needs a known label_size instead of {}".format(
+                context['label_size']))
+
+    if context['font_size'] == FIT_FONT_SIZE:
+        font = None
+    else:
+        font = load_font(context['font_index'], context['font_size'])
+    template = Template(name, context, label, font)
+    for field in template.fields:
+        if field in TEMPLATE_OPTIONS:
+            raise ValueError("Can't use {{{}}} as placeholder".format(field))
+    return template
+
 def main():
-    global FONTS, DEFAULT_FONT, WEBSITE, DEFAULTS, DEVICE
+    global FONTS, DEFAULT_FONT, WEBSITE, DEFAULTS, FONT_CACHE, \
+           RENDER_CACHE, MAX_BATCH_SIZE, RENDER_POOL, \
+           PNG_COMPRESS_LEVEL, CONFIG_RESPONSE, RASTER_CACHE, \
+           PREVIEW_STREAM, PREVIEW_KEEPALIVE, STRIP_CACHE, LABEL_TEMPLATES, \
+           MEASURE_CACHE, SPOOL, SPOOL_RETRY_INTERVAL, SPOOL_MAX_WAIT
+
+    register_metrics()
 
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-c', '--config', nargs='?',
@@ -388,35 +1615,37 @@ def main():
 
     DEFAULTS = config['defaults']
 
-    DEVICE = config['printer'].get('device')
+    devices = [device.strip() for device in
+               config['printer'].get('device', '').split(',') if device.strip()]
 
-    if not DEVICE:
-        devices_found = []
+    if not devices:
         for backend in config['printer']['discover'].split(','):
             factory = brother_ql.backends.backend_factory(backend.strip())
-            devices_found += factory['list_available_devices']()
+            for device in factory['list_available_devices']():
+                if device['identifier'] not in devices:
+                    devices.append(device['identifier'])
 
-        if not devices_found:
+        if not devices:
             LOGGER.critical("No device specified and discovery failed. Exiting!")
             sys.exit(2)
 
-        DEVICE = devices_found[0]['identifier']
-        LOGGER.info("No device specified. Selecting %s", DEVICE)
+        LOGGER.info("No device specified. Selecting %s", ', '.join(devices))
 
-    if config['fonts'].getboolean('system_fonts'):
-        fontconfig_instance = fontconfig.Config.get_current()
-    else:
-        fontconfig_instance = fontconfig.Config.create()
+    CONNECTIONS.idle_timeout = config['printer'].getfloat('idle_timeout')
+    CONNECTIONS.health_check_interval = config['printer'].getfloat('health_check_interval')
+    CONNECTIONS.status_history = config['printer'].getint('status_history')
 
-    for folder in config['fonts']['additional_paths'].split(','):
-        if folder.strip():
-            fontconfig_instance.app_font_add_dir(folder)
+    for device in devices:
+        printer = PRINTERS.add(Printer(device, print_label,
+                                       config['printer'].getfloat('status_interval'),
+                                       config['printer'].getfloat('status_max_age')))
+        printer.start()
 
-    props_to_query = (fontconfig.PROP.FILE, fontconfig.PROP.FAMILY, fontconfig.PROP.STYLE)
+    MAX_BATCH_SIZE = config['printer'].getint('max_batch_size')
 
-    FONTS = []
-    for font in fontconfig_instance.font_list(fontconfig.Pattern.create(), props_to_query):
-        FONTS.append(tuple(font.get(prop, 0)[0] or '' for prop in props_to_query))
+    FONTS = load_fonts(config['fonts'].getboolean('system_fonts'),
+                       config['fonts']['additional_paths'].split(','),
+                       os.path.expanduser(config['fonts']['index_file']))
 
     if not FONTS:
         sys.stderr.write("Not a single font was found on your system. Please " + \
@@ -424,17 +1653,52 @@ def main():
                          "additional font pathes in the configuration.\n")
         sys.exit(2)
 
-    FONTS.sort(key=lambda font: font[1:])
+    FONT_CACHE = LRUCache(config['fonts'].getint('cache_size'))
+    RENDER_CACHE = LRUCache(config['cache'].getint('render_memory') << 20,
+                            weigh=render_weight)
+    RASTER_CACHE = LRUCache(config['cache'].getint('raster_memory') << 20,
+                            weigh=len)
+    STRIP_CACHE = LRUCache(config['cache'].getint('strip_memory') << 20,
+                           weigh=STRIP_CACHE.weigh)
+    MEASURE_CACHE = LRUCache(config['cache'].getint('measure_size'))
+
+    PNG_COMPRESS_LEVEL = config['render'].getint('png_compress_level')
+
+    PREVIEW_STREAM = config['preview'].getboolean('stream')
+    PREVIEW_KEEPALIVE = config['preview'].getfloat('keepalive')
+    if PREVIEW_STREAM and config['server']['server'] == 'wsgiref':
+        # an open stream would block the only thread of the server
+        LOGGER.warning('Streamed previews need a server with several workers, disabling them')
+        PREVIEW_STREAM = False
+    if config['preview']['max_streams']:
+        PREVIEW_SESSIONS.max_streams = config['preview'].getint('max_streams')
+    else:
+        PREVIEW_SESSIONS.max_streams = \
+                config['server'].getint('workers', DEFAULT_WORKERS) - STREAM_FREE_WORKERS
+    if PREVIEW_STREAM and PREVIEW_SESSIONS.max_streams <= 0:
+        LOGGER.warning('Not enough server workers for streamed previews, disabling them')
+        PREVIEW_STREAM = False
+
+    RENDER_POOL.shutdown()
+    if config['render'].getboolean('processes'):
+        RENDER_POOL = WorkerPool(config['render'].getint('workers'),
+                                 config['render'].getint('queue_length'),
+                                 True, init_render_worker,
+                                 (FONTS, config['fonts'].getint('cache_size'),
+                                  config['cache'].getint('strip_memory') << 20,
+                                  config['cache'].getint('measure_size')))
+    else:
+        RENDER_POOL = WorkerPool(config['render'].getint('workers'),
+                                 config['render'].getint('queue_length'))
 
-    default_font_index = -1
+    font_indexes = {}
+    for i, (path, family, style) in enumerate(FONTS):
+        font_indexes.setdefault((family, style), i)
 
     for default_font in DEFAULTS['font'].split(','):
         (default_family, default_style) = default_font.split(":")
-        for i, (path, family, style) in enumerate(FONTS):
-            if default_family == family and default_style == style:
-                default_font_index = i
-                break
-        if default_font_index != -1:
+        default_font_index = font_indexes.get((default_family, default_style))
+        if default_font_index is not None:
             break
     else: # no default font found
         sys.stderr.write("Could not find any of the default fonts. Choosing a " + \
@@ -444,8 +1708,54 @@ def main():
 
     DEFAULTS["font_index"] = str(default_font_index)
 
+    LABEL_TEMPLATES = {}
+    for section in config.sections():
+        if not section.startswith('template:'):
+            continue
+        name = section[len('template:'):]
+        try:
+            LABEL_TEMPLATES[name] = load_template(name, config[section], font_indexes)
+        except (LookupError, ValueError) as e:
+            sys.stderr.write("Invalid template {}: {}\n".format(name, e))
+            sys.exit(2)
+
+    CONFIG_RESPONSE = config_response()
+
+    SPOOL_RETRY_INTERVAL = config['spool'].getfloat('retry_interval')
+    SPOOL_MAX_WAIT = config['spool'].getfloat('max_wait')
+    if config['spool']['directory']:
+        SPOOL = Spool(os.path.expanduser(config['spool']['directory']))
+        for printer in PRINTERS:
+            known_info = SPOOL.printer(printer.device)
+            if known_info is not None and known_info[0] in MODELS_BY_IDENTIFIER \
+                    and printer.monitor.known_info is None:
+                printer.monitor.known_info = (MODELS_BY_IDENTIFIER[known_info[0]],
+                                              LABELS_BY_IDENTIFIER.get(known_info[1]))
+            printer.monitor.add_listener(functools.partial(remember_printer, printer.device))
+            if printer.monitor.known_info is not None:
+                remember_printer(printer.device, printer.monitor.known_info)
+        for metadata in SPOOL.load():
+            printer = PRINTERS.printers.get(metadata['device'])
+            if printer is None:
+                LOGGER.warning('Keeping spooled job %s for %s, which isn\'t configured',
+                               metadata['id'], metadata['device'])
+                continue
+            printer.queue.submit(metadata, print_spooled)
+        if len(SPOOL):
+            LOGGER.info('Resuming %d spooled jobs', len(SPOOL))
 
-    bottle.run(**config['server'], debug=args.debug or config['logging'].getboolean('debug'))
+
+    try:
+        server = server_options(config['server'])
+    except ValueError as e:
+        sys.stderr.write("{}\n".format(e))
+        sys.exit(2)
+
+    try:
+        bottle.run(**server, debug=args.debug or config['logging'].getboolean('debug'))
+    finally:
+        PREVIEW_SESSIONS.close_all()
+        CONNECTIONS.close_all()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,146 @@
+"""
+Module for collecting metrics and exposing them in the Prometheus text
+format.
+"""
+
+import contextlib
+import threading
+import time
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1, 2.5, 5, 10, 30)
+
+METRICS = []
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value)
+                          .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in labels) + '}'
+
+class Metric(object):
+    """
+    Base class of all metrics, which register themselves on creation
+    """
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Return a list of (name, labels, value) tuples
+        """
+        raise NotImplementedError()
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for (name, labels, value) in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(labels), repr(float(value))))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0, 0]
+            (counts, _, _) = entry = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe the time spent in the with block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((self.name + '_bucket', key + (('le', repr(float(bound))), ),
+                                    bucket_count))
+                samples.append((self.name + '_bucket', key + (('le', '+Inf'), ), count))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, count))
+        return samples
+
+class Callback(Metric):
+    """
+    Metric whose values are read when exposed. The function returns a list
+    of (labels, value) tuples with labels as dict.
+    """
+    def __init__(self, name, documentation, type, function):
+        super().__init__(name, documentation)
+        self.type = type
+        self.function = function
+
+    def samples(self):
+        return [(self.name, tuple(labels.items()), value)
+                for labels, value in self.function()]
+
+def expose():
+    """
+    Return all metrics in the Prometheus text format
+    """
+    return '\n'.join(metric.expose() for metric in METRICS) + '\n'
+
+STAGE_SECONDS = Histogram('printui_stage_duration_seconds',
+        'Time spent in each stage of rendering and printing a label', ('stage', ))
+
+STATUS_WAIT_SECONDS = Histogram('printui_status_wait_seconds',
+        'Time spent waiting for each expected status reply of the printer', ('status', ))
+
+REQUEST_SECONDS = Histogram('printui_request_duration_seconds',
+        'Time spent handling API requests', ('endpoint', ))
+
+PRINTER_ERRORS = Counter('printui_printer_errors_total',
+        'Errors reported by the printers, counted when they appear', ('error', ))
+
+PRINTER_TIMEOUTS = Counter('printui_printer_timeouts_total',
+        'Timeouts while waiting for a reply of the printer')
+
+PREVIEWS_SUPERSEDED = Counter('printui_previews_superseded_total',
+        'Streamed previews dropped because newer parameters arrived', ('stage', ))
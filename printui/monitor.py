@@ -0,0 +1,173 @@
+"""
+Module for keeping a cached snapshot of the printer status, so requests
+don't need to talk to the device themselves.
+"""
+
+import logging
+import threading
+import time
+
+from .printer import PrinterDevice, DeviceBusy, CONNECTIONS, status_info, status_model
+
+LOGGER = logging.getLogger(__name__)
+
+class StatusMonitor(object):
+    """
+    Polls the status of a device every interval seconds in a background
+    thread and keeps the latest Status together with the resolved
+    (model, label). Every status read from the device by anyone else, like
+    the replies to a print job, updates the snapshot as well. Readers get
+    the snapshot as long as it is younger than max_age seconds, otherwise
+    it is refreshed on their request, unless the device is in use. They
+    never wait for the device, a busy device leaves the snapshot stale.
+    An interval of 0 disables the background thread.
+    """
+    def __init__(self, device, interval=2, max_age=5):
+        self.device = device
+        self.interval = interval
+        self.max_age = max_age
+        self.updated = None
+        self.last_status = None
+        self.last_info = None
+        self.last_error = None
+        # the last (model, label) that could be resolved, kept while the
+        # device is unreachable
+        self.known_info = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.RLock()
+        self._thread = None
+        CONNECTIONS.add_listener(device, self.update)
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='status-monitor')
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh(blocking=False)
+            except Exception as e:
+                LOGGER.debug('Polling the status of %s failed: %r', self.device, e)
+            time.sleep(self.interval)
+
+    def refresh(self, blocking=True):
+        """
+        Query the device for its current status. The status reaches update()
+        as a listener of the connections. Unless blocking is set, a device
+        in use by someone else is left alone.
+
+        returns: False if the device was busy
+        """
+        with self._refresh_lock:
+            try:
+                with PrinterDevice(self.device, blocking=blocking) as printer:
+                    printer.status()
+            except DeviceBusy:
+                return False
+            except Exception as e:
+                self.update(error=e)
+                raise
+        return True
+
+    def add_listener(self, callback):
+        """
+        Register a callback called with the new known_info whenever it
+        changes
+        """
+        self._listeners.append(callback)
+
+    def update(self, status=None, error=None):
+        """
+        Store a new snapshot. May also be called by anyone else who just
+        received a status from the device.
+        """
+        info = None
+        model = None
+        if error is None:
+            model = status_model(status)
+            try:
+                info = status_info(status)
+            except Exception as e:
+                error = e
+
+        with self._lock:
+            self.updated = time.monotonic()
+            self.last_status = status
+            self.last_info = info
+            self.last_error = error
+
+            known_info = self.known_info
+            if info is not None:
+                self.known_info = info
+            elif model is not None:
+                # a status with errors still tells the model, the label is
+                # the one seen last
+                if known_info is not None and known_info[0] == model:
+                    self.known_info = (model, known_info[1])
+                else:
+                    self.known_info = (model, None)
+            changed = self.known_info != known_info
+            known_info = self.known_info
+
+        if changed:
+            for callback in self._listeners:
+                try:
+                    callback(known_info)
+                except Exception as e:
+                    LOGGER.error('Status listener of %s failed: %r', self.device, e)
+
+    def age(self):
+        if self.updated is None:
+            return None
+        return time.monotonic() - self.updated
+
+    def snapshot(self):
+        """
+        Return a tuple (status, info, error), no older than max_age seconds
+        unless the device is busy
+        """
+        age = self.age()
+        # if someone else is refreshing already, their status isn't waited
+        # for either
+        if (age is None or age > self.max_age) and \
+                self._refresh_lock.acquire(blocking=False):
+            try:
+                self.refresh(blocking=False)
+            except Exception:
+                pass
+            finally:
+                self._refresh_lock.release()
+
+        with self._lock:
+            return (self.last_status, self.last_info, self.last_error)
+
+    def cached(self):
+        """
+        Return the snapshot like snapshot() without refreshing it, or
+        (None, None, None) if it is older than max_age seconds
+        """
+        with self._lock:
+            if self.updated is None or time.monotonic() - self.updated > self.max_age:
+                return (None, None, None)
+            return (self.last_status, self.last_info, self.last_error)
+
+    def status(self):
+        (status, info, error) = self.snapshot()
+        if status is None:
+            raise error or DeviceBusy("The printer is busy.")
+        return status
+
+    def info(self):
+        """
+        Same as PrinterDevice.info() but served from the snapshot
+        """
+        (status, info, error) = self.snapshot()
+        if error is not None:
+            raise error
+        if info is None:
+            raise DeviceBusy("The printer is busy.")
+        return info
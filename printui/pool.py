@@ -0,0 +1,71 @@
+"""
+Module for running CPU heavy work like label rendering on a bounded pool of
+worker threads or processes.
+"""
+
+import concurrent.futures
+import os
+import threading
+
+class PoolBusy(RuntimeError):
+    """
+    Raised when a pool has no free worker and its queue is full
+    """
+
+class WorkerPool(object):
+    """
+    Runs functions on a fixed number of workers. At most queue_length calls
+    wait for a free worker, further calls are rejected with PoolBusy unless
+    they ask to block until there is room.
+    Using processes requires the function and its arguments to be picklable,
+    the initializer is run once in every worker process.
+    """
+    def __init__(self, workers=0, queue_length=16, processes=False,
+                 initializer=None, initargs=()):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_length = queue_length
+        self.processes = processes
+        self.rejected = 0
+        if processes:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, initializer=initializer, initargs=initargs)
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='render',
+                    initializer=initializer, initargs=initargs)
+        self._slots = threading.BoundedSemaphore(self.workers + queue_length)
+
+    def submit(self, fn, *args, block=False):
+        """
+        Schedule fn(*args) and return its future
+        """
+        if not self._slots.acquire(blocking=block):
+            self.rejected += 1
+            raise PoolBusy("The server is busy, please try again later.")
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    def run(self, fn, *args, block=False):
+        """
+        Call fn(*args) on a worker and wait for the result
+        """
+        return self.submit(fn, *args, block=block).result()
+
+    def pending(self):
+        return self.workers + self.queue_length - self._slots._value
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_length': self.queue_length,
+            'pending': self.pending(),
+            'rejected': self.rejected,
+            }
@@ -0,0 +1,155 @@
+"""
+Module for the sessions of streamed previews. A client pushes the
+parameters of its preview whenever they change and receives the rendered
+images on a separate stream. Only the newest parameters are rendered,
+anything pushed while a render runs replaces the pending parameters.
+"""
+
+import threading
+import time
+
+class PreviewSession(object):
+    """
+    The latest parameters pushed by one client. Each update increases the
+    generation, so a stream can tell whether the parameters it is rendering
+    were superseded in the meantime, and cancels the render of the previous
+    parameters if it didn't start yet.
+    """
+    def __init__(self):
+        self.params = None
+        self.generation = 0
+        self.sequence = -1
+        self.stream = 0
+        self.streams = 0
+        self.future = None
+        self.last_used = time.monotonic()
+        self._condition = threading.Condition()
+
+    def update(self, params, sequence=None):
+        """
+        Replace the parameters. Updates with a lower sequence number than a
+        previous one arrived out of order and are ignored.
+
+        returns: False if the update was ignored
+        """
+        with self._condition:
+            self.last_used = time.monotonic()
+            if sequence is not None:
+                if sequence <= self.sequence:
+                    return False
+                self.sequence = sequence
+            self.params = params
+            self.generation += 1
+            if self.future is not None:
+                self.future.cancel()
+                self.future = None
+            self._condition.notify_all()
+            return True
+
+    def superseded(self, generation):
+        return self.generation != generation
+
+    def submitted(self, generation):
+        """
+        Return a callback that keeps the future of a render for the given
+        generation, so the next update can cancel it
+        """
+        def callback(future):
+            with self._condition:
+                if self.generation != generation:
+                    future.cancel()
+                else:
+                    self.future = future
+        return callback
+
+    def open_stream(self):
+        """
+        Register a new stream, which replaces any stream opened before
+
+        returns: id of the stream
+        """
+        with self._condition:
+            self.stream += 1
+            self.streams += 1
+            self._condition.notify_all()
+            return self.stream
+
+    def close_stream(self, stream):
+        with self._condition:
+            self.streams -= 1
+            self.last_used = time.monotonic()
+
+    def wait(self, stream, generation, timeout):
+        """
+        Wait until there are parameters newer than the given generation
+
+        returns: tuple (generation, params), (None, None) if nothing changed
+                 within timeout seconds or the stream was replaced
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.generation != generation or
+                                             self.stream != stream, timeout)
+            if self.stream != stream or self.generation == generation:
+                return (None, None)
+            return (self.generation, self.params)
+
+    def is_current(self, stream):
+        return self.stream == stream
+
+    def close(self):
+        """
+        End the current stream
+        """
+        with self._condition:
+            self.stream += 1
+            self._condition.notify_all()
+
+class PreviewSessions(object):
+    """
+    All preview sessions by the id chosen by the client. Sessions without an
+    open stream are dropped after max_idle seconds. Each open stream holds a
+    worker of the server, so at most max_streams are open at once.
+    """
+    def __init__(self, max_idle=300, max_streams=4):
+        self.max_idle = max_idle
+        self.max_streams = max_streams
+        self.open_streams = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def reserve_stream(self):
+        """
+        Take one of the max_streams slots for a stream
+
+        returns: False if all slots are taken
+        """
+        with self._lock:
+            if self.open_streams >= self.max_streams:
+                return False
+            self.open_streams += 1
+            return True
+
+    def release_stream(self):
+        with self._lock:
+            self.open_streams -= 1
+
+    def get(self, session_id):
+        with self._lock:
+            now = time.monotonic()
+            for key, session in list(self._sessions.items()):
+                if session.streams <= 0 and now - session.last_used > self.max_idle:
+                    del self._sessions[key]
+
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = PreviewSession()
+            return session
+
+    def close_all(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            session.close()
+
+    def __len__(self):
+        return len(self._sessions)
@@ -2,14 +2,31 @@
 Module for interpreting the status return by several Brother label printers.
 """
 
+import logging
+import os
+import select
 import struct
+import threading
 import time
 
-from attr import attrs, attrib
-
 import brother_ql.backends
-import brother_ql.labels
-import brother_ql.models
+import brother_ql.backends.linux_kernel
+import brother_ql.backends.network
+try:
+    import usb.core
+    import brother_ql.backends.pyusb
+except ImportError:
+    usb = None
+
+from .index import LABELS_BY_TAPE_SIZE, MODELS_BY_IDENTIFIER
+from .metrics import STAGE_SECONDS, STATUS_WAIT_SECONDS, PRINTER_ERRORS, \
+                     PRINTER_TIMEOUTS
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of unknown values kept per StatusValueEnum, so a device sending
+# garbage can't grow them without limit
+MAX_UNKNOWN_MEMBERS = 64
 
 class StatusValueEnum(type):
     """
@@ -25,6 +42,7 @@ class StatusValueEnum(type):
         enum_class.__new__ = metacls.__get_member__
         enum_class._member_names_ = []
         enum_class._value2member_map_ = {}
+        enum_class._unknown_members_ = {}
 
         for member_name, value in classdict.items():
             if member_name[0] == '_':
@@ -46,8 +64,11 @@ class StatusValueEnum(type):
         return enum_class
 
     def __get_member__(cls, code):
-        if code in cls._value2member_map_:
-            return cls._value2member_map_[code]
+        enum_member = cls._value2member_map_.get(code)
+        if enum_member is None:
+            enum_member = cls._unknown_members_.get(code)
+        if enum_member is not None:
+            return enum_member
 
         enum_member = object.__new__(cls)
         enum_member.name = 'UNDEFINED'
@@ -56,7 +77,8 @@ class StatusValueEnum(type):
         enum_member.__objclass__ = cls
         enum_member.__init__()
 
-        cls._value2member_map_[code] = enum_member
+        if len(cls._unknown_members_) < MAX_UNKNOWN_MEMBERS:
+            cls._unknown_members_[code] = enum_member
 
         return enum_member
 
@@ -265,80 +287,143 @@ class ErrorInformations(metaclass=StatusValueEnum):
     SYSTEM_ERROR     = 0x8000, "System error"
 
 STATUS_STRUCT = struct.Struct('>BBBHBBBHBBBBBBBBBBHBBBBLxx')
-@attrs
-class Status:
+
+class StatusField(object):
+    """
+    Field of a Status, decoded from the frame each time it is accessed
+    """
+    __slots__ = ('offset', 'unpack', 'convert')
+
+    def __init__(self, offset, fmt, convert=None):
+        self.offset = offset
+        self.unpack = struct.Struct('>' + fmt).unpack_from
+        self.convert = convert
+
+    def __get__(self, status, owner=None):
+        if status is None:
+            return self
+        value = self.unpack(status.data, self.offset)[0]
+        if self.convert is None:
+            return value
+        return self.convert(value)
+
+def error_table(shift):
+    """
+    Return the errors set in each value of one byte of the error
+    information bitmask
+    """
+    return tuple(tuple(error for error in ErrorInformations
+                       if error.value & (byte << shift))
+                 for byte in range(256))
+
+ERRORS_LOW_BYTE = error_table(0)
+ERRORS_HIGH_BYTE = error_table(8)
+
+# models reporting additional errors (PT-P9 series)
+EXTENDED_ERROR_MODELS = (0x306F, 0x3070, 0x3071)
+# models with a two byte media length (TD-4D series)
+MEDIA_LENGTH_MSB_MODELS = (0x3537, 0x3538, 0x3539, 0x3541, 0x3542)
+
+class Status(object):
+    """
+    A 32 byte status frame, kept as the bytes it was read as and decoded
+    only when a field is accessed. The data isn't copied, so it must not be
+    changed afterwards, StatusHistory.snapshot() hands out copies of its
+    buffer for that reason.
+    """
+    __slots__ = ('data', )
+
     # Offset 0: Always 0x80
-    print_head_mark: int = attrib()
+    print_head_mark = StatusField(0, 'B')
     # Offset 1: Size of this struct, always 32 bytes
-    size: int = attrib()
+    size = StatusField(1, 'B')
     # Offset 2: Always 'B'
-    brother_code: int = attrib(converter=chr)
+    brother_code = StatusField(2, 'B', chr)
     # Offset 3: Two bytes describing the series and the model
-    series_model_code: Models = attrib(converter=Models)
+    series_model_code = StatusField(3, 'H', Models)
     # Offset 5: Country code, always '0'
-    country_code: int = attrib(converter=chr)
+    country_code = StatusField(5, 'B', chr)
     # Offset 6: Battery level (PT-P9 series only)
-    battery_level: BatteryLevels = attrib(converter=BatteryLevels)
+    battery_level = StatusField(6, 'B', BatteryLevels)
     # Offset 7: Additional error code (PT-P9 series only)
-    extended_error: AdditionalErrors = attrib(converter=AdditionalErrors)
+    extended_error = StatusField(7, 'B', AdditionalErrors)
     # Offset 8: Two byte bitmask describing errors
-    error_information: int = attrib()
+    error_information = StatusField(8, 'H')
     # Offset 10: Label media width in millimeters
-    media_width: int = attrib()
+    media_width = StatusField(10, 'B')
     # Offset 11: Label media type
-    media_type: MediaTypes = attrib(converter=MediaTypes)
+    media_type = StatusField(11, 'B', MediaTypes)
     # Offset 12: Number of colors, always 0
-    number_of_colors: int = attrib()
+    number_of_colors = StatusField(12, 'B')
     # Offset 13: Second byte of the media_length field (TD-4D series only)
     #            PT series documentation calls this fonts but always set to 0
-    media_length_msb: int = attrib()
+    media_length_msb = StatusField(13, 'B')
     # Offset 14: Media sensor value (TD-4D series only)
     #            PT series documentation calls this japanese fonts but always
     #            set to 0
-    media_sensor_value: int = attrib()
+    media_sensor_value = StatusField(14, 'B')
     # Offset 15: TODO
-    mode: int = attrib()
+    mode = StatusField(15, 'B')
     # Offset 16: Density, always 0
-    density: int = attrib()
+    density = StatusField(16, 'B')
     # Offset 17: Label media length in millimeters
     #            (first byte of two byte value for TD-4D series)
-    media_length_lsb: int = attrib()
+    media_length_lsb = StatusField(17, 'B')
     # Offset 18: Reason for this status message
-    status_type: StatusTypes = attrib(converter=StatusTypes)
+    status_type = StatusField(18, 'B', StatusTypes)
     # Offset 19: Printing phase
-    phase_type: PhaseTypes = attrib(converter=PhaseTypes)
+    phase_type = StatusField(19, 'B', PhaseTypes)
     # Offset 20: Phase number (PT series only)
-    phase_number: int = attrib()
+    phase_number = StatusField(20, 'H')
     # Offset 22: Notification code
-    notification_number: Notifications = attrib(converter=Notifications)
+    notification_number = StatusField(22, 'B', Notifications)
     # Offset 23: Expansion area (number of bytes), always 0
-    expansion_area: int = attrib()
+    expansion_area = StatusField(23, 'B')
     # Offset 24: Tape color (PT series only)
-    tape_color_information: TapeColors = attrib(converter=TapeColors)
+    tape_color_information = StatusField(24, 'B', TapeColors)
     # Offset 25: Text color (PT series only)
-    text_color_information: TextColors = attrib(converter=TextColors)
+    text_color_information = StatusField(25, 'B', TextColors)
     # Offset 26: Four byte bitmask describing hardware settings (some PT models only)
-    hardware_settings: int = attrib()
+    hardware_settings = StatusField(26, 'L')
+
+    FIELDS = ('print_head_mark', 'size', 'brother_code', 'series_model_code',
+              'country_code', 'battery_level', 'extended_error',
+              'error_information', 'media_width', 'media_type',
+              'number_of_colors', 'media_length_msb', 'media_sensor_value',
+              'mode', 'density', 'media_length_lsb', 'status_type',
+              'phase_type', 'phase_number', 'notification_number',
+              'expansion_area', 'tape_color_information',
+              'text_color_information', 'hardware_settings')
+
+    def __init__(self, data):
+        if len(data) != STATUS_STRUCT.size:
+            raise ValueError("Expected a status frame of {} bytes, got {}".format(
+                STATUS_STRUCT.size, len(data)))
+        self.data = data
+
+    @property
+    def model_code(self):
+        return self.data[3] << 8 | self.data[4]
 
     @property
     def errors(self):
-        errors = []
-        for error in ErrorInformations:
-            if error.value & self.error_information:
-                errors.append(error)
+        mask = self.error_information
+        errors = ERRORS_LOW_BYTE[mask & 0xFF]
+        if mask > 0xFF:
+            errors += ERRORS_HIGH_BYTE[mask >> 8]
 
-        # only for PT-P9 series
-        if self.series_model_code in (0x306F, 0x3070, 0x3071):
-            if self.extended_error != AdditionalErrors.NONE:
-                errors.append(self.extended_error)
+        if self.model_code in EXTENDED_ERROR_MODELS:
+            extended_error = self.extended_error
+            if extended_error != AdditionalErrors.NONE:
+                errors += (extended_error, )
 
         return errors
 
     @property
     def media_length(self):
-        if self.series_model_code in (0x3537, 0x3538, 0x3539, 0x3541, 0x3542):
+        if self.model_code in MEDIA_LENGTH_MSB_MODELS:
             # two byte value only for TD-4D series
-            return (self.media_length_msb << 8) & self.media_length_lsb
+            return (self.media_length_msb << 8) | self.media_length_lsb
         else:
             return self.media_length_lsb
 
@@ -350,95 +435,454 @@ class Status:
             return self.phase_type, PrintingPhaseNumbers(self.phase_number)
         return self.phase_type, None
 
+    def __eq__(self, other):
+        if not isinstance(other, Status):
+            return NotImplemented
+        return self.data == other.data
+
+    def __hash__(self):
+        return hash(bytes(self.data))
+
+    def __repr__(self):
+        return 'Status({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.FIELDS))
+
     @classmethod
     def from_bytes(cls, data):
-        return cls(*STATUS_STRUCT.unpack(data))
+        return cls(data)
+
+class StatusHistory(object):
+    """
+    Ring buffer of the last size status frames received from a device. The
+    frames are copied into a buffer allocated once, so recording them
+    doesn't allocate anything.
+    """
+    def __init__(self, size=64):
+        self.size = size
+        self._frames = bytearray(size * STATUS_STRUCT.size)
+        self._times = [0.0] * size
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def append(self, frame):
+        if self.size <= 0:
+            return
+        with self._lock:
+            start = self._next * STATUS_STRUCT.size
+            self._frames[start:start + STATUS_STRUCT.size] = frame
+            self._times[self._next] = time.time()
+            self._next = (self._next + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+    def __len__(self):
+        return self._count
+
+    def snapshot(self):
+        """
+        Return a list of tuples (time, Status) from the oldest frame on. The
+        frames are copied while holding the lock, so frames received
+        meanwhile don't overwrite them.
+        """
+        with self._lock:
+            first = (self._next - self._count) % self.size if self.size > 0 else 0
+            frames = []
+            for i in range(self._count):
+                index = (first + i) % self.size
+                start = index * STATUS_STRUCT.size
+                frames.append((self._times[index],
+                               Status(bytes(self._frames[start:start + STATUS_STRUCT.size]))))
+            return frames
+
+    def __iter__(self):
+        return iter(self.snapshot())
 
 class PrinterError(RuntimeError):
     def __init__(self, errors):
         super().__init__(*errors)
         self.errors = errors
 
-class PrinterDevice(object):
-    def __init__(self, device):
-        self.device = device
-        backend_type = brother_ql.backends.guess_backend(device)
-        self.backend_class = brother_ql.backends.backend_factory(backend_type)['backend_class']
-    def __enter__(self):
-        self.backend = self.backend_class(self.device)
-        return self
+class DeviceBusy(RuntimeError):
+    """
+    Raised instead of waiting for a device that is in use by someone else
+    """
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.backend.dispose()
-        self.backend = None
+# Seconds to wait for the reply to a status request
+STATUS_TIMEOUT = .5
+# Seconds to wait for each of the replies to a print request
+PRINT_TIMEOUT = 7.5
 
-    def status(self):
-        self.backend.write(b'\x1B\x69\x53')
-        for i in range(10):
-            data = self.backend.read()
-            if data:
-                break
-            time.sleep(.02)
+class StatusReader(object):
+    """
+    Reads 32 byte status frames from a backend. Instead of polling the
+    backend in fixed intervals it waits for the file descriptor or socket
+    to become readable, or blocks on the USB endpoint with a timeout, so a
+    frame is returned as soon as the printer sends it. Backends without
+    either fall back to polling.
+    """
+    def __init__(self, backend, history=None):
+        self.backend = backend
+        self.history = history
+        self.buffer = bytearray()
+        if isinstance(backend, brother_ql.backends.network.BrotherQLBackendNetwork):
+            self._read = self._read_socket
+        elif isinstance(backend, brother_ql.backends.linux_kernel.BrotherQLBackendLinuxKernel):
+            self._read = self._read_fd
+        elif usb is not None and \
+                isinstance(backend, brother_ql.backends.pyusb.BrotherQLBackendPyUSB):
+            self._read = self._read_usb
+        elif hasattr(backend, 'fileno'):
+            self._read = self._read_fileno
         else:
-            raise TimeoutError("Failed to read data from printer")
-        return Status.from_bytes(data)
+            self._read = self._read_poll
+
+    def _read_socket(self, timeout):
+        (readable, _, _) = select.select([self.backend.s], [], [], timeout)
+        if not readable:
+            return b''
+        data = self.backend.s.recv(64)
+        if not data:
+            raise ConnectionError("Connection closed by printer")
+        return data
+
+    def _read_fd(self, timeout):
+        (readable, _, _) = select.select([self.backend.read_dev], [], [], timeout)
+        if not readable:
+            return b''
+        return os.read(self.backend.read_dev, 64)
+
+    def _read_usb(self, timeout):
+        try:
+            return bytes(self.backend.read_dev.read(64, max(1, int(timeout * 1000))))
+        except usb.core.USBTimeoutError:
+            return b''
+
+    def _read_fileno(self, timeout):
+        (readable, _, _) = select.select([self.backend], [], [], timeout)
+        if not readable:
+            return b''
+        return self.backend.read(64)
+
+    def _read_poll(self, timeout):
+        data = self.backend.read()
+        if not data:
+            time.sleep(min(timeout, .005))
+        return data
+
+    def read(self, timeout):
+        """
+        Return the next Status, waiting at most timeout seconds for it
+        """
+        deadline = time.monotonic() + timeout
+        while len(self.buffer) < STATUS_STRUCT.size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                PRINTER_TIMEOUTS.inc()
+                raise TimeoutError("Failed to read data from printer")
+            self.buffer += self._read(remaining)
+        frame = bytes(self.buffer[:STATUS_STRUCT.size])
+        del self.buffer[:STATUS_STRUCT.size]
+        if self.history is not None:
+            self.history.append(frame)
+        return Status.from_bytes(frame)
+
+    def drain(self):
+        """
+        Discard frames that arrived before the request that is about to be sent
+        """
+        while self._read(0):
+            pass
+        self.buffer.clear()
+
+def request_status(reader):
+    """
+    Send a status request to the backend and wait for the reply
+    """
+    reader.drain()
+    reader.backend.write(b'\x1B\x69\x53')
+    with STATUS_WAIT_SECONDS.time(status=StatusTypes.REQUEST.name):
+        return reader.read(STATUS_TIMEOUT)
 
-    def info(self):
-        status = self.status()
+def status_model(status):
+    """
+    Look up the model described by a status, which is reported along with
+    errors as well
 
-        if status.errors:
-            raise PrinterError(status.errors)
+    returns: the model, None if it is unknown
+    """
+    return MODELS_BY_IDENTIFIER.get(status.series_model_code.description)
 
-        if status.media_type == MediaTypes.NO_MEDIA:
-            label_ = None
-        else:
-            for label in brother_ql.labels.LabelsManager().iter_elements():
-                if label.tape_size == (status.media_width, status.media_length):
-                    label_ = label
-                    break
-            else: # no match
-                raise RuntimeError("Unknown label type: {}mm x {}mm ({})".format(
-                    status.media_width,
-                    status.media_length,
-                    status.media_type.description,
-                    ))
+def status_info(status):
+    """
+    Look up the model and the loaded label described by a status
 
-        for model in brother_ql.models.ModelsManager().iter_elements():
-            if model.identifier == status.series_model_code.description:
-                model_ = model
-                break
-        else: # no match
-            raise RuntimeError("Unknown model: {}".format(
-                status.series_model_code.description,
+    returns: tuple (model, label), label is None if no media is loaded
+    """
+    if status.errors:
+        raise PrinterError(status.errors)
+
+    if status.media_type == MediaTypes.NO_MEDIA:
+        label_ = None
+    else:
+        label_ = LABELS_BY_TAPE_SIZE.get((status.media_width, status.media_length))
+        if label_ is None:
+            raise RuntimeError("Unknown label type: {}mm x {}mm ({})".format(
+                status.media_width,
+                status.media_length,
+                status.media_type.description,
                 ))
 
-        return (model_, label_)
+    model_ = status_model(status)
+    if model_ is None:
+        raise RuntimeError("Unknown model: {}".format(
+            status.series_model_code.description,
+            ))
+
+    return (model_, label_)
+
+# Backends in addition to those of brother_ql, by the prefix of the device
+# identifiers they handle
+BACKENDS = {}
 
-    def print(self, qlr):
-        self.backend.write(qlr.data)
+def backend_class(device):
+    """
+    Return the backend class for a device identifier
+    """
+    for prefix, backend_class_ in BACKENDS.items():
+        if device.startswith(prefix):
+            return backend_class_
+    backend_type = brother_ql.backends.guess_backend(device)
+    return brother_ql.backends.backend_factory(backend_type)['backend_class']
 
-        # Print request is answered three times:
+class Connection(object):
+    """
+    A long-lived backend for one device. The backend is opened on first use
+    and kept open between requests. Only one user can hold the connection
+    at a time.
+    """
+    def __init__(self, device, status_history=64):
+        self.device = device
+        self.backend_class = backend_class(device)
+        self.backend = None
+        self.reader = None
+        self.history = StatusHistory(status_history)
+        self.last_used = 0
+        self.lock = threading.RLock()
+
+    def open(self, health_check_interval):
+        """
+        Return an open backend, checking the health of a connection that has
+        been idle for longer than health_check_interval seconds
+        """
+        if self.backend is not None and \
+                time.monotonic() - self.last_used > health_check_interval:
+            try:
+                request_status(self.reader)
+            except Exception as e:
+                LOGGER.info('Health check for %s failed, reconnecting: %r',
+                            self.device, e)
+                self.close()
+
+        if self.backend is None:
+            LOGGER.debug('Connecting to %s', self.device)
+            self.backend = self.backend_class(self.device)
+            self.reader = StatusReader(self.backend, self.history)
+
+        return self.backend
+
+    def close(self):
+        if self.backend is None:
+            return
+        try:
+            self.backend.dispose()
+        except Exception as e:
+            LOGGER.debug('Failed to dispose backend for %s: %r', self.device, e)
+        self.backend = None
+        self.reader = None
+
+    def close_if_idle(self, idle_timeout):
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.backend is not None and \
+                    time.monotonic() - self.last_used > idle_timeout:
+                LOGGER.debug('Closing idle connection to %s', self.device)
+                self.close()
+        finally:
+            self.lock.release()
+
+class ConnectionManager(object):
+    """
+    Keeps one persistent connection per device. Connections are closed after
+    they were idle for idle_timeout seconds and reopened whenever a request
+    failed with anything but an error reported by the printer itself.
+    An idle_timeout of 0 closes the connection after every request.
+    The last status_history status frames of each device are kept, and
+    listeners are told about every status read through a PrinterDevice.
+    """
+    def __init__(self, idle_timeout=60, health_check_interval=30, status_history=64):
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.status_history = status_history
+        self._connections = {}
+        self._listeners = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def add_listener(self, device, callback):
+        """
+        Call callback with every Status read from the device
+        """
+        with self._lock:
+            self._listeners.setdefault(device, []).append(callback)
+
+    def status_received(self, device, status):
+        # errors are counted when they appear, not for every status
+        # repeating them
+        errors = {error.name for error in status.errors}
+        previous = self._errors.get(device, set())
+        if errors or previous:
+            for name in errors - previous:
+                PRINTER_ERRORS.inc(error=name)
+            self._errors[device] = errors
+
+        for callback in self._listeners.get(device, ()):
+            try:
+                callback(status)
+            except Exception as e:
+                LOGGER.debug('Status listener for %s failed: %r', device, e)
+
+    def acquire(self, device, blocking=True):
+        """
+        Return the open connection of a device, waiting for whoever uses it
+        unless blocking is False, which raises DeviceBusy instead
+        """
+        with self._lock:
+            connection = self._connections.get(device)
+            if connection is None:
+                connection = self._connections[device] = Connection(
+                        device, self.status_history)
+            if self._reaper is None and self.idle_timeout > 0:
+                self._reaper = threading.Thread(target=self._reap, daemon=True,
+                                                name='printer-connection-reaper')
+                self._reaper.start()
+
+        if not connection.lock.acquire(blocking=blocking):
+            raise DeviceBusy("The printer is busy.")
+        try:
+            connection.open(self.health_check_interval)
+        except BaseException:
+            connection.lock.release()
+            raise
+        return connection
+
+    def release(self, connection, failed=False):
+        try:
+            if failed or self.idle_timeout <= 0:
+                connection.close()
+            connection.last_used = time.monotonic()
+        finally:
+            connection.lock.release()
+
+    def history(self, device):
+        """
+        Return the StatusHistory of a device, None if it was never connected
+        """
+        with self._lock:
+            connection = self._connections.get(device)
+        return connection.history if connection is not None else None
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+        for connection in connections:
+            with connection.lock:
+                connection.close()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 2, 1))
+            with self._lock:
+                connections = list(self._connections.values())
+            for connection in connections:
+                connection.close_if_idle(self.idle_timeout)
+
+CONNECTIONS = ConnectionManager()
+
+class PrinterDevice(object):
+    """
+    Context manager borrowing the persistent connection of a device from a
+    ConnectionManager for the duration of the with block. Unless blocking
+    is set, entering it raises DeviceBusy if the device is in use.
+    """
+    def __init__(self, device, connections=None, blocking=True):
+        self.device = device
+        self.connections = connections or CONNECTIONS
+        self.blocking = blocking
+        self.connection = None
+        self.backend = None
+        self.reader = None
+
+    def __enter__(self):
+        self.connection = self.connections.acquire(self.device, self.blocking)
+        self.backend = self.connection.backend
+        self.reader = self.connection.reader
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # errors reported by the printer leave the connection intact,
+        # everything else might have left it in an unknown state
+        failed = exc_type is not None and not issubclass(exc_type, PrinterError)
+        self.connections.release(self.connection, failed)
+        self.connection = None
+        self.backend = None
+        self.reader = None
+
+    def status(self):
+        status = request_status(self.reader)
+        self.connections.status_received(self.device, status)
+        return status
+
+    def info(self):
+        return status_info(self.status())
+
+    def print(self, data, pages=1, page_done=None):
+        """
+        Write the raster data of a print job with the given number of pages
+        and wait until the printer completed all of them. page_done is
+        called with the index of each page once it is completed, so the
+        pages printed before an error are known.
+        """
+        self.reader.drain()
+        with STAGE_SECONDS.time(stage='device_write'):
+            self.backend.write(data)
+
+        # Print request is answered with
         #   1. phase changed to printing
-        #   2. printing complete
+        #   2. printing complete, for each page
         #   3. phase changed to ready
-        for expected_status in (StatusTypes.PHASE_CHANGE,
-                                StatusTypes.COMPLETE,
-                                StatusTypes.PHASE_CHANGE):
-            for i in range(250):
-                data = self.backend.read()
-                if data:
-                    break
-                time.sleep(.02)
-            else:
-                raise TimeoutError("Failed to read data from printer")
-
-            status = Status.from_bytes(data)
+        completed = 0
+        while True:
+            start = time.perf_counter()
+            status = self.reader.read(PRINT_TIMEOUT)
+            STATUS_WAIT_SECONDS.observe(time.perf_counter() - start,
+                                        status=status.status_type.name)
+            self.connections.status_received(self.device, status)
 
             if status.errors:
                 raise PrinterError(status.errors)
 
-            if status.status_type != expected_status:
-                raise RuntimeError("Expected status \"{}\" but got \"{}\"".format(
-                    expected_status.description,
+            if status.status_type == StatusTypes.COMPLETE:
+                if page_done is not None:
+                    page_done(completed)
+                completed += 1
+            elif status.status_type == StatusTypes.PHASE_CHANGE:
+                if completed >= pages and status.phase_type == PhaseTypes.READY:
+                    return
+            else:
+                raise RuntimeError("Expected status \"{}\" or \"{}\" but got \"{}\"".format(
+                    StatusTypes.PHASE_CHANGE.description,
+                    StatusTypes.COMPLETE.description,
                     status.status_type.description,
                     ))
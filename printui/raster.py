@@ -0,0 +1,132 @@
+"""
+Module to convert rendered labels to the raster data of a page without
+going through brother_ql.conversion.convert(). The label is reduced to one
+bit in a single pass first, so rotating, padding and mirroring it for the
+print head only handles an eighth of the data. The result is the same as
+the one of convert() for black and white printing without dithering.
+"""
+
+import PIL.Image
+
+from brother_ql import BrotherQLUnsupportedCmd
+from brother_ql.devicedependent import right_margin_addition
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def threshold_cutoff(threshold):
+    """
+    Return the darkness from which on convert() prints a pixel
+    """
+    return min(255, max(0, int((100.0 - threshold) / 100.0 * 255)))
+
+def threshold_bitmap(image, threshold):
+    """
+    Reduce an image to one bit with the ink set, the same way convert()
+    inverts and thresholds it
+    """
+    cutoff = threshold_cutoff(threshold)
+    return image.convert('L').point(lambda x: 255 if 255 - x >= cutoff else 0, '1')
+
+def head_bitmap(image, label, model, pixel_width, threshold, rotate, endless):
+    """
+    Return the one bit bitmap of an image as the print head sees it: rotated,
+    padded to the full width of the head and mirrored
+
+    returns: the bitmap or None if the image would need to be scaled, which
+             is left to convert()
+    raises: ValueError if the label is wider than the print head
+    """
+    (printable_width, printable_length) = label.dots_printable
+    bitmap = threshold_bitmap(image, threshold)
+
+    if endless:
+        if rotate not in ('auto', 0):
+            bitmap = bitmap.rotate(int(rotate), expand=True)
+        if bitmap.width != printable_width:
+            return None
+    else:
+        if rotate == 'auto':
+            if bitmap.size == (printable_length, printable_width):
+                bitmap = bitmap.rotate(90, expand=True)
+        elif int(rotate) != 0:
+            bitmap = bitmap.rotate(int(rotate), expand=True)
+        if bitmap.size != (printable_width, printable_length):
+            raise ValueError("Bad image dimensions: %s. Expecting: %s." % (
+                bitmap.size, (printable_width, printable_length)))
+
+    # a label wider than the print head can't be printed by this model,
+    # which convert() fails on in add_raster_data()
+    if bitmap.width > pixel_width:
+        raise ValueError('Wrong pixel width: {}, expected {}'.format(
+            bitmap.width, pixel_width))
+
+    right_margin = label.offset_r + right_margin_addition.get(model.identifier, 0)
+    if endless and bitmap.width == pixel_width:
+        # convert() only pads narrower endless labels
+        right_margin = 0
+    # mirroring first puts the right margin on the left. The padding is
+    # white, which only prints at a threshold of 100.
+    padding = 1 if threshold_cutoff(threshold) == 0 else 0
+    head = PIL.Image.new('1', (pixel_width, bitmap.height), padding)
+    head.paste(bitmap.transpose(PIL.Image.Transpose.FLIP_LEFT_RIGHT), (right_margin, 0))
+    return head
+
+def raster_rows(bitmap):
+    """
+    Return the uncompressed raster graphics transfer commands for all rows
+    of a bitmap
+    """
+    row_length = bitmap.width // 8
+    data = bitmap.tobytes()
+    header = bytes((0x67, 0x00, row_length))
+
+    if numpy is not None:
+        rows = numpy.empty((bitmap.height, row_length + len(header)), numpy.uint8)
+        rows[:, :len(header)] = numpy.frombuffer(header, numpy.uint8)
+        rows[:, len(header):] = numpy.frombuffer(data, numpy.uint8).reshape(-1, row_length)
+        return rows.tobytes()
+
+    return b''.join(header + data[start:start + row_length]
+                    for start in range(0, len(data), row_length))
+
+def convert_page(qlr, image, label, model, threshold=70, rotate='auto', cut=True,
+                 endless=False):
+    """
+    Append the commands of a single page to qlr, like convert() does for each
+    image after the commands initializing the printer
+
+    returns: False if the image can't be converted here and convert() has
+             to be used instead
+    """
+    head = head_bitmap(image, label, model, qlr.get_pixel_width(), threshold,
+                       rotate, endless)
+    if head is None:
+        return False
+
+    (tape_width, tape_length) = label.tape_size
+    qlr.add_status_information()
+    qlr.mtype = 0x0A if endless else 0x0B
+    qlr.mwidth = tape_width
+    qlr.mlength = 0 if endless else tape_length
+    qlr.pquality = True
+    qlr.add_media_and_quality(head.height)
+    try:
+        if cut:
+            qlr.add_autocut(True)
+            qlr.add_cut_every(1)
+    except BrotherQLUnsupportedCmd:
+        pass
+    try:
+        qlr.dpi_600 = False
+        qlr.cut_at_end = cut
+        qlr.two_color_printing = False
+        qlr.add_expanded_mode()
+    except BrotherQLUnsupportedCmd:
+        pass
+    qlr.add_margins(label.feed_margin)
+    qlr.data += raster_rows(head)
+    qlr.add_print()
+    return True
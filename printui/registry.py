@@ -0,0 +1,128 @@
+"""
+Module for managing several printers and routing print jobs between them.
+"""
+
+import collections
+import threading
+
+from .monitor import StatusMonitor
+from .jobs import PrintQueue
+
+class Printer(object):
+    """
+    A registered device with its status monitor and print queue
+    """
+    def __init__(self, device, handler, status_interval=2, status_max_age=5):
+        self.device = device
+        self.monitor = StatusMonitor(device, status_interval, status_max_age)
+        self.queue = PrintQueue(device, handler)
+
+    def start(self):
+        self.monitor.start()
+        self.queue.start()
+
+    def to_dict(self):
+        result = {'identifier': self.device}
+        try:
+            (model, label) = self.monitor.info()
+        except Exception as e:
+            result['model'] = None
+            result['label'] = None
+            result['error'] = repr(e)
+        else:
+            result['model'] = model.identifier
+            result['label'] = label.identifier if label else None
+            result['error'] = None
+        result['status_age'] = self.monitor.age()
+        result['queue'] = self.queue.stats()
+        return result
+
+class PrinterRegistry(object):
+    """
+    Holds all printers in the order they were added. The first one is the
+    default for requests that don't ask for a specific printer.
+    """
+    def __init__(self):
+        self.printers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, printer):
+        self.printers[printer.device] = printer
+        return printer
+
+    def __iter__(self):
+        return iter(list(self.printers.values()))
+
+    def __len__(self):
+        return len(self.printers)
+
+    def get(self, device=None):
+        """
+        Return the printer with the given identifier or the default one
+        """
+        if not device:
+            if not self.printers:
+                raise LookupError("No printer configured.")
+            return next(iter(self.printers.values()))
+        try:
+            return self.printers[device]
+        except KeyError:
+            raise LookupError("Unknown printer: {}".format(device))
+
+    def candidates(self, label_size='auto', device=None):
+        """
+        Return the printers a job for the given label size can go to, that
+        is all printers with that label loaded (any label for 'auto') or
+        the requested one. Only cached statuses are used, so routing never
+        waits for a printer. If no printer is known to fit, the printers
+        whose state is unknown are candidates and the job finds out on the
+        printer. A single printer is always a candidate.
+        """
+        if device:
+            return [self.get(device)]
+
+        candidates = []
+        unknown = []
+        for printer in self:
+            (_, info, error) = printer.monitor.cached()
+            if info is None:
+                if error is None:
+                    unknown.append(printer)
+                continue
+            label = info[1]
+            if label is None:
+                continue
+            if label_size == 'auto' or label.identifier == label_size:
+                candidates.append(printer)
+
+        if not candidates:
+            candidates = unknown
+
+        if not candidates and len(self) == 1:
+            # let the job fail on the printer with the actual reason
+            return list(self)
+
+        if not candidates:
+            if label_size == 'auto':
+                raise LookupError("No printer with a label loaded.")
+            raise LookupError("No printer with label {} loaded.".format(label_size))
+
+        return candidates
+
+    def submit(self, params, handler=None, items=None, label_size='auto',
+               device=None):
+        """
+        Queue a job on the printer with the fewest queued jobs out of the
+        candidates, preferring the earlier ones on a tie
+        """
+        candidates = self.candidates(label_size, device)
+        with self._lock:
+            printer = min(candidates, key=lambda printer: printer.queue.load())
+            return printer.queue.submit(params, handler, items)
+
+    def get_job(self, job_id):
+        for printer in self:
+            job = printer.queue.get(job_id)
+            if job is not None:
+                return job
+        return None
@@ -0,0 +1,86 @@
+"""
+Module with the server adapters to run the web service with concurrent
+requests.
+"""
+
+import concurrent.futures
+import logging
+import wsgiref.simple_server
+
+import bottle
+
+LOGGER = logging.getLogger(__name__)
+
+# Workers of the servers that support setting their number, unless
+# configured
+DEFAULT_WORKERS = 8
+
+class PooledWSGIServer(wsgiref.simple_server.WSGIServer):
+    """
+    WSGIServer handling each request on a fixed pool of threads
+    """
+    workers = DEFAULT_WORKERS
+
+    def server_activate(self):
+        super().server_activate()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.workers, thread_name_prefix='http')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+class ThreadedServer(bottle.WSGIRefServer):
+    """
+    The wsgiref server of bottle, but with a pool of worker threads
+    """
+    def run(self, app):
+        workers = int(self.options.pop('workers', PooledWSGIServer.workers))
+        server_class = type('PooledWSGIServer', (PooledWSGIServer, ),
+                            {'workers': workers})
+        self.options.setdefault('server_class', server_class)
+        super().run(app)
+
+# All of these run in a single process, so printer access stays serialized
+# by the locks of the connection manager. The value names the option the
+# number of workers is passed as.
+SERVERS = {
+    'threaded': (ThreadedServer, 'workers'),
+    'wsgiref': ('wsgiref', None),
+    'waitress': ('waitress', 'threads'),
+    'cheroot': ('cheroot', 'numthreads'),
+    }
+
+def server_options(config):
+    """
+    Translate the server section of the configuration to arguments for
+    bottle.run(). Servers supporting it get DEFAULT_WORKERS workers if
+    the configuration doesn't set their number.
+    """
+    options = dict(config)
+    name = options.pop('server', 'threaded')
+    workers = options.pop('workers', None)
+
+    if name not in SERVERS:
+        raise ValueError("Unsupported server: {}. Must be one of {}.".format(
+            name, ', '.join(SERVERS)))
+
+    (server, workers_option) = SERVERS[name]
+    options['server'] = server
+    if workers_option is not None:
+        options[workers_option] = int(workers) if workers is not None else DEFAULT_WORKERS
+    elif workers is not None:
+        LOGGER.warning('Server %s does not support setting the number of workers', name)
+
+    return options
@@ -0,0 +1,188 @@
+"""
+Module with a simulated printer backend that speaks the status protocol of
+the Brother QL printers, so the service can be run and benchmarked without
+any hardware.
+
+Simulated printers are addressed as
+
+    sim://<model>/<label>?latency=<seconds>&error=<errors>&fail_every=<n>&drop_every=<n>
+
+model:      Model identifier, e.g. QL-800 (default: QL-800)
+label:      Identifier of the loaded label or "none" (default: 62)
+latency:    Seconds each print job takes (default: 0), the completion of
+            each page is reported at the end
+error:      Comma separated names of ErrorInformations reported by the
+            printer, e.g. COVER_OPEN (default: none)
+fail_every: Only every n-th print job fails with the errors, instead of
+            every status (default: 0, which means always)
+drop_every: Every n-th print job is never completed, so the service runs
+            into a timeout (default: 0, which means never)
+"""
+
+import collections
+import os
+import threading
+import urllib.parse
+
+import brother_ql.backends
+import brother_ql.reader
+
+from .index import LABELS_BY_IDENTIFIER
+from .printer import BACKENDS, STATUS_STRUCT, Models, MediaTypes, StatusTypes, \
+                     PhaseTypes, ErrorInformations
+
+STATUS_REQUEST = b'\x1B\x69\x53'
+PRINT_COMMAND = b'\x1A'
+
+# commands of the raster protocol by their first byte, longest first
+OPCODES = {}
+for opcode in sorted(brother_ql.reader.OPCODES, key=len, reverse=True):
+    OPCODES.setdefault(opcode[0], []).append(opcode)
+
+def count_pages(data):
+    """
+    Count the pages of raster data, that is the print commands ending each
+    page, skipping over the payload of the other commands
+    """
+    pages = 0
+    i = 0
+    while i < len(data):
+        for opcode in OPCODES.get(data[i], ()):
+            if data.startswith(opcode, i):
+                break
+        else:
+            # unknown or the invalidate command
+            i += 1
+            continue
+        (name, length) = brother_ql.reader.OPCODES[opcode][:2]
+        i += len(opcode)
+        if 'raster' in name:
+            i += data[i + 1] + 2
+        elif length > 0:
+            i += length
+        elif name == 'print':
+            pages += 1
+    return pages
+
+def status_frame(model=Models.QL800, media_width=0, media_length=0,
+                 media_type=MediaTypes.NO_MEDIA, status_type=StatusTypes.REQUEST,
+                 phase_type=PhaseTypes.READY, errors=0):
+    """
+    Return a 32 byte status frame as sent by the printers
+    """
+    return STATUS_STRUCT.pack(
+        0x80, STATUS_STRUCT.size, ord('B'), model.value, ord('0'), 0, 0,
+        errors, media_width, media_type.value, 0, 0, 0, 0, 0, media_length,
+        status_type.value, phase_type.value, 0, 0, 0, 0, 0, 0)
+
+class SimulatedBackend(brother_ql.backends.BrotherQLBackendGeneric):
+    """
+    Backend answering status requests and print jobs like a printer would.
+    Replies are written to a pipe, so the status reader can wait for them
+    with select().
+    """
+    # number of print jobs and bytes received, by device identifier
+    jobs = collections.Counter()
+    bytes_written = collections.Counter()
+
+    def __init__(self, device_specifier):
+        url = urllib.parse.urlsplit(device_specifier)
+        options = dict(urllib.parse.parse_qsl(url.query))
+        self.device = device_specifier
+
+        model_name = url.netloc or 'QL-800'
+        for model in Models:
+            if model.description == model_name:
+                self.model = model
+                break
+        else:
+            raise ValueError("Unknown model: {}".format(model_name))
+
+        label_name = url.path.strip('/') or '62'
+        if label_name == 'none':
+            self.media = (0, 0, MediaTypes.NO_MEDIA)
+        else:
+            try:
+                label = LABELS_BY_IDENTIFIER[label_name]
+            except KeyError:
+                raise ValueError("Unknown label: {}".format(label_name))
+            (width, length) = label.tape_size
+            self.media = (width, length,
+                          MediaTypes.DIE_CUT if length else MediaTypes.CONTINUOUS)
+
+        self.latency = float(options.get('latency', 0))
+        self.errors = 0
+        for name in options.get('error', '').split(','):
+            if name.strip():
+                self.errors |= getattr(ErrorInformations, name.strip()).value
+        self.fail_every = int(options.get('fail_every', 0))
+        self.drop_every = int(options.get('drop_every', 0))
+
+        (self.read_dev, self.write_dev) = os.pipe()
+        os.set_blocking(self.read_dev, False)
+        self.lock = threading.Lock()
+        self.timers = []
+
+    def frame(self, status_type=StatusTypes.REQUEST, phase_type=PhaseTypes.READY,
+              errors=0):
+        (width, length, media_type) = self.media
+        return status_frame(self.model, width, length, media_type,
+                            status_type, phase_type, errors)
+
+    def reply(self, *frames):
+        with self.lock:
+            if self.write_dev is not None:
+                os.write(self.write_dev, b''.join(frames))
+
+    def _write(self, data):
+        SimulatedBackend.bytes_written[self.device] += len(data)
+
+        if data == STATUS_REQUEST:
+            errors = 0 if self.fail_every else self.errors
+            self.reply(self.frame(errors=errors))
+            return
+
+        pages = count_pages(data)
+        if not pages:
+            return
+
+        SimulatedBackend.jobs[self.device] += 1
+        job = SimulatedBackend.jobs[self.device]
+
+        if self.errors and (not self.fail_every or job % self.fail_every == 0):
+            self.reply(self.frame(StatusTypes.ERROR, errors=self.errors))
+            return
+
+        self.reply(self.frame(StatusTypes.PHASE_CHANGE, PhaseTypes.PRINTING))
+        if self.drop_every and job % self.drop_every == 0:
+            return
+
+        finished = (self.frame(StatusTypes.COMPLETE, PhaseTypes.PRINTING), ) * pages + \
+                (self.frame(StatusTypes.PHASE_CHANGE, PhaseTypes.READY), )
+        if self.latency > 0:
+            timer = threading.Timer(self.latency, self.reply, finished)
+            timer.daemon = True
+            timer.start()
+            self.timers = [t for t in self.timers if t.is_alive()] + [timer]
+        else:
+            self.reply(*finished)
+
+    def _read(self, length=32):
+        try:
+            return os.read(self.read_dev, length)
+        except BlockingIOError:
+            return b''
+
+    def fileno(self):
+        return self.read_dev
+
+    def _dispose(self):
+        for timer in self.timers:
+            timer.cancel()
+        with self.lock:
+            if self.write_dev is not None:
+                os.close(self.write_dev)
+                os.close(self.read_dev)
+                self.write_dev = None
+
+BACKENDS['sim://'] = SimulatedBackend
@@ -0,0 +1,152 @@
+"""
+Module for keeping print jobs on disk until their printer is ready, so
+they survive the printer being off or out of labels as well as restarts of
+the service.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+def sync_directory(directory):
+    """
+    Flush the entries of a directory to disk, so renames in it are durable
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_file(path, data):
+    """
+    Write data to a temporary file, flush it to disk and rename it to path,
+    so path either doesn't exist or has the complete data
+    """
+    temp_file = path + '.tmp'
+    with open(temp_file, 'wb') as output:
+        output.write(data)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(temp_file, path)
+
+class Spool(object):
+    """
+    Directory of print jobs, each stored as its raster data in <id>.bin
+    and its metadata in <id>.json. The raster data is on disk before the
+    metadata is written, so a job is complete once its metadata exists.
+    Files of incomplete jobs are removed by load(). Ids start with the time
+    the job was stored, so they sort in the order the jobs were accepted.
+    The model and label last seen on each printer are kept in
+    printers.state, so jobs can be rendered after a restart while the
+    printer is off.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._pending = set()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._printers = {}
+        try:
+            with open(self._path('printers', '.state')) as printers:
+                self._printers = json.load(printers)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            LOGGER.error('Failed to read the printers of the spool: %r', e)
+
+    def _path(self, job_id, extension):
+        return os.path.join(self.directory, job_id + extension)
+
+    def put(self, data, metadata):
+        """
+        Store the raster data and metadata of a job durably
+
+        returns: the metadata with the id of the job added
+        """
+        job_id = '{:020d}-{}'.format(time.time_ns(), uuid.uuid4().hex)
+        metadata = dict(metadata, id=job_id, created=time.time())
+
+        write_file(self._path(job_id, '.bin'), data)
+        sync_directory(self.directory)
+        write_file(self._path(job_id, '.json'), json.dumps(metadata).encode('utf-8'))
+        sync_directory(self.directory)
+
+        with self._lock:
+            self._pending.add(job_id)
+        return metadata
+
+    def read(self, job_id):
+        with open(self._path(job_id, '.bin'), 'rb') as data:
+            return data.read()
+
+    def remove(self, job_id):
+        """
+        Remove a printed job, the metadata first so it isn't printed again
+        if the service stops in between
+        """
+        for extension in ('.json', '.bin'):
+            try:
+                os.unlink(self._path(job_id, extension))
+            except FileNotFoundError:
+                pass
+        sync_directory(self.directory)
+        with self._lock:
+            self._pending.discard(job_id)
+
+    def load(self):
+        """
+        Return the metadata of all stored jobs in the order they were
+        accepted, removing what is left of jobs that weren't stored
+        completely
+        """
+        names = sorted(os.listdir(self.directory))
+        complete = {name[:-len('.json')] for name in names if name.endswith('.json')}
+
+        jobs = []
+        for name in names:
+            (job_id, extension) = os.path.splitext(name)
+            if extension == '.json':
+                try:
+                    with open(os.path.join(self.directory, name)) as metadata:
+                        jobs.append(json.load(metadata))
+                except (OSError, ValueError) as e:
+                    LOGGER.error('Failed to read spooled job %s: %r', name, e)
+            elif extension == '.tmp' or (extension == '.bin' and job_id not in complete):
+                LOGGER.info('Removing incomplete spooled job %s', name)
+                os.unlink(os.path.join(self.directory, name))
+
+        with self._lock:
+            self._pending.update(job['id'] for job in jobs)
+        return jobs
+
+    def printer(self, device):
+        """
+        Return the identifiers (model, label) last seen on a device, label is
+        None if there was none
+
+        returns: tuple, None if the device was never seen
+        """
+        with self._lock:
+            info = self._printers.get(device)
+        return tuple(info) if info is not None else None
+
+    def set_printer(self, device, model, label):
+        """
+        Store the identifiers of the model and label seen on a device
+        """
+        with self._lock:
+            if self._printers.get(device) == [model, label]:
+                return
+            self._printers[device] = [model, label]
+            write_file(self._path('printers', '.state'),
+                       json.dumps(self._printers).encode('utf-8'))
+
+    def __len__(self):
+        return len(self._pending)
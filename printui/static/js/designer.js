@@ -2,6 +2,9 @@
 
 var font_families = [];
 var preview_throttle = '';
+var preview_source = null;
+var preview_session = Math.random().toString(36).slice(2) + Date.now().toString(36);
+var preview_seq = 0;
 
 function setStatus(status, message) {
     var style = {
@@ -34,7 +37,7 @@ function formData() {
     return {
         text:           $('#labelText').val(),
         font_index:     $('#fontStyle option:selected').val(),
-        font_size:      $('#fontSize').val(),
+        font_size:      $('#fontSizeFit').is(':checked') ? 'fit' : $('#fontSize').val(),
         label_size:     $('#labelSize option:selected').val(),
         align:          $('input:radio[name=fontAlign]:checked').val(),
         align_vertical: $('input:radio[name=alignVertical]:checked').val(),
@@ -47,27 +50,80 @@ function formData() {
     }
 }
 
+function showPreview(src, label_width, label_height, font_size) {
+    var img = $('#previewImg')[0];
+    if (img.src && img.src.startsWith('blob:')) {
+        URL.revokeObjectURL(img.src);
+    }
+    img.src = src;
+    $('#labelWidth').html( (label_width /300*2.54).toFixed(1));
+    $('#labelHeight').html((label_height/300*2.54).toFixed(1));
+    if (font_size && $('#fontSizeFit').is(':checked')) {
+        // show the fitted size, so it can be kept when unchecking fit
+        $('#fontSize').val(font_size);
+    }
+}
+
+function previewWidth() {
+    return Math.ceil($('#previewImg').parent().width() * (window.devicePixelRatio || 1));
+}
+
+function openPreviewStream() {
+    preview_source = new EventSource('/api/text/preview/stream/' + preview_session);
+    preview_source.onmessage = function(event) {
+        var data = JSON.parse(event.data);
+        if (data.success) {
+            showPreview('data:image/png;base64,' + data.image, data.width, data.height,
+                        data.font_size);
+        } else {
+            setStatus('failure', data.messages);
+        }
+    };
+    preview_source.onerror = function() {
+        // the browser reconnects on its own unless the stream is unavailable
+        if (preview_source.readyState === EventSource.CLOSED) {
+            preview_source = null;
+            preview();
+        }
+    };
+}
+
 function preview() {
+    if (preview_source) {
+        // the server only renders the latest parameters, no need to throttle
+        var data = formData();
+        data.width = previewWidth();
+        data.seq = preview_seq++;
+        $.ajax({
+            type:     'POST',
+            url:      '/api/text/preview/stream/' + preview_session,
+            data:     data,
+            dataType: 'json',
+        });
+        return;
+    }
     if (preview_throttle) {
         preview_throttle = 'is_running_obsolete';
         return;
     }
     preview_throttle = 'is_running';
+    var width = previewWidth();
     $.ajax({
         type:        'POST',
-        url:         '/api/text/preview?return_format=json',
+        url:         '/api/text/preview?return_format=thumbnail&width=' + width,
         contentType: 'application/x-www-form-urlencoded; charset=UTF-8',
         data:        formData(),
-        success: function(data) {
-            if(data.success) {
-                $('#previewImg').attr('src', 'data:image/png;base64,' + data.image);
-                var img = $('#previewImg')[0];
-                img.onload = function() {
-                    $('#labelWidth').html( (img.naturalWidth /300*2.54).toFixed(1));
-                    $('#labelHeight').html((img.naturalHeight/300*2.54).toFixed(1));
-                };
+        xhrFields:   {responseType: 'blob'},
+        success: function(data, status, xhr) {
+            if (data.type === 'image/png') {
+                showPreview(URL.createObjectURL(data),
+                            xhr.getResponseHeader('X-Label-Width'),
+                            xhr.getResponseHeader('X-Label-Height'),
+                            xhr.getResponseHeader('X-Font-Size'));
             } else {
-                setStatus('failure', data.messages);
+                data.text().then(function(text) {
+                    setStatus('failure', JSON.parse(text).messages);
+                });
             }
         },
         complete: function() {
@@ -81,6 +137,27 @@ function preview() {
     });
 }
 
+function pollJob(job_id) {
+    $.ajax({
+        type:     'GET',
+        dataType: 'json',
+        url:      '/api/jobs/' + job_id,
+        success:  function(data) {
+            if (!data.success) {
+                onPrinterResponse(data);
+            } else if (data.job.state === 'done') {
+                onPrinterResponse({success: true});
+            } else if (data.job.state === 'failed') {
+                onPrinterResponse({success: false, messages: data.job.messages});
+            } else {
+                setStatus('waiting', 'Print job is ' + data.job.state + '...');
+                setTimeout(function() { pollJob(job_id); }, 250);
+            }
+        },
+        error:    onPrinterResponse
+    });
+}
+
 function print() {
     $('#printButton').prop('disabled', true);
     setStatus('waiting', 'Processing print request...');
@@ -89,7 +166,13 @@ function print() {
         dataType: 'json',
         data:     formData(),
         url:      '/api/text/print',
-        success:  onPrinterResponse,
+        success:  function(data) {
+            if (data.success) {
+                pollJob(data.job_id);
+            } else {
+                onPrinterResponse(data);
+            }
+        },
         error:    onPrinterResponse
     });
 }
@@ -115,12 +198,12 @@ function onStatusResponse(data) {
     onPrinterResponse(data);
 }
 
-function updatePrinterStatus() {
+function updatePrinterStatus(refresh) {
     $('#printButton').prop('disabled', true);
     setStatus('waiting', 'Requesting printer status...');
     $.ajax({
         type:     'GET',
-        url:      '/api/status',
+        url:      '/api/status' + (refresh ? '?refresh=true' : ''),
         success:  onStatusResponse,
         error:    onStatusResponse
     });
@@ -131,10 +214,10 @@ function updateFontStyles() {
     $('#fontStyle').find('option').remove();
     $.each(font_families[$('#fontFamily option:selected').text()], function(i, info) {
         $('#fontStyle').append($('<option>', {
-            text:     info[2],
+            text:     info[1],
             value:    info[0],
         }));
-        if(info[2] == old_style) {
+        if(info[1] == old_style) {
             $('#fontStyle').val(info[0]);
             old_style = "";
         }
@@ -165,19 +248,18 @@ $.ajax({
             }));
         });
 
-        $.each(data.fonts, function(i, font) {
-            var index = font[0],
-                family = font[1];
-            if(!font_families[family]) {
-                font_families[family] = [];
-                $('#fontFamily').append($('<option>', {
-                    text: family,
-                }));
-            }
-            font_families[family].push(font);
-            if(index == data.default_values.font_index) {
-                $('#fontFamily option:contains("' + family + '")').attr("selected", "selected");
-            }
+        $.each(data.fonts, function(i, group) {
+            var family = group[0],
+                styles = group[1];
+            font_families[family] = styles;
+            $('#fontFamily').append($('<option>', {
+                text: family,
+            }));
+            $.each(styles, function(j, info) {
+                if(info[0] == data.default_values.font_index) {
+                    $('#fontFamily option:contains("' + family + '")').attr("selected", "selected");
+                }
+            });
         });
 
         updateFontStyles();
@@ -196,6 +278,9 @@ $.ajax({
 
         updatePrinterStatus();
 
+        if (data.preview_stream && window.EventSource) {
+            openPreviewStream();
+        }
         preview();
     }
 });
@@ -0,0 +1,65 @@
+"""
+Module for label templates, layouts stored in the configuration whose text
+contains placeholders like "Asset #{id}". Everything but the values of the
+placeholders is fixed, so the parameters are parsed and the lines without
+placeholders are measured once when the template is loaded.
+"""
+
+import string
+
+from . import text as text_layout
+
+def placeholders(text):
+    """
+    Return the names of the placeholders in a template text
+
+    returns: list of names in the order they appear first
+    """
+    names = []
+    for (_, name, _, _) in string.Formatter().parse(text):
+        if name is None:
+            continue
+        if not name.isidentifier():
+            raise ValueError("Invalid placeholder {{{}}}, placeholders must be "
+                             "names".format(name))
+        if name not in names:
+            names.append(name)
+    return names
+
+class Template(object):
+    """
+    A named layout with a parsed context like render_image() builds it,
+    whose text is a format string, for a fixed label
+    """
+    def __init__(self, name, context, label, font):
+        self.name = name
+        self.context = context
+        self.label = label
+        self.fields = placeholders(context['text'])
+
+        # lines without placeholders look the same on every label, unless
+        # the font size is fitted to the text. Empty lines are replaced
+        # with a space like render_image() does.
+        self.metrics = {}
+        if font is not None:
+            for line in context['text'].split('\n'):
+                if not placeholders(line):
+                    line = line.format() or ' '
+                    self.metrics[line] = text_layout.measure(font, line)
+
+    def fill(self, values):
+        """
+        Return the text with the placeholders replaced by the given values
+        """
+        missing = [name for name in self.fields if name not in values]
+        if missing:
+            raise ValueError("Missing values for: {}".format(', '.join(missing)))
+        return self.context['text'].format_map(
+                {name: values[name] for name in self.fields})
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'fields': self.fields,
+            'label_size': self.label.identifier,
+            }
@@ -0,0 +1,121 @@
+"""
+Module for laying out and drawing multiline text line by line, so that the
+layout can be cached and drawn without laying out the text again, and the
+bitmaps of single lines can be cached and a label with many lines is
+composed from them instead of being drawn as a whole. The layout matches
+the one of ImageDraw.multiline_text().
+"""
+
+import collections
+
+import PIL.Image
+import PIL.ImageDraw
+
+# spacing between lines used by ImageDraw.multiline_text()
+SPACING = 4
+
+ALIGNMENTS = ('left', 'center', 'right', 'justify')
+
+# a line or, for justified text, a word at its position relative to the
+# anchor of the text
+Piece = collections.namedtuple('Piece', ('x', 'y', 'text'))
+
+def measure(font, text):
+    """
+    Measure a single line
+
+    returns: tuple (length, bbox) like font.getlength() and font.getbbox()
+    """
+    return (font.getlength(text), font.getbbox(text))
+
+def layout(font, lines, align, metrics=None):
+    """
+    Position the lines of a text like ImageDraw.multiline_text() does.
+    metrics maps lines to their measure(), lines found there aren't
+    measured again.
+
+    returns: tuple (pieces, bbox), with bbox like
+             ImageDraw.multiline_textbbox() at (0, 0)
+    """
+    if len(lines) > 1 and align not in ALIGNMENTS:
+        raise ValueError('align must be "left", "center", "right" or "justify"')
+
+    line_spacing = font.getbbox('A')[3] + SPACING
+    measured = {}
+    for line in lines:
+        if line not in measured:
+            measured[line] = (metrics or {}).get(line) or measure(font, line)
+    widths = [measured[line][0] for line in lines]
+    max_width = max(widths)
+
+    pieces = []
+    top = 0
+    for index, (line, width) in enumerate(zip(lines, widths)):
+        left = 0
+        difference = max_width - width
+        if align == 'center':
+            left += difference / 2.0
+        elif align == 'right':
+            left += difference
+
+        words = line.split(' ')
+        if align == 'justify' and difference != 0 and index != len(lines) - 1 \
+                and len(words) > 1:
+            word_widths = [font.getlength(word) for word in words]
+            gap = (max_width - sum(word_widths)) / (len(words) - 1)
+            for word, word_width in zip(words, word_widths):
+                pieces.append(Piece(left, top, word))
+                left += word_width + gap
+        else:
+            pieces.append(Piece(left, top, line))
+        top += line_spacing
+
+    bbox = None
+    for piece in pieces:
+        if piece.text in measured:
+            (left, top, right, bottom) = measured[piece.text][1]
+        else:
+            (left, top, right, bottom) = font.getbbox(piece.text)
+        piece_bbox = (left + piece.x, top + piece.y, right + piece.x, bottom + piece.y)
+        if bbox is None:
+            bbox = piece_bbox
+        else:
+            bbox = (min(bbox[0], piece_bbox[0]), min(bbox[1], piece_bbox[1]),
+                    max(bbox[2], piece_bbox[2]), max(bbox[3], piece_bbox[3]))
+
+    return (pieces, bbox)
+
+def draw_strip(font, text):
+    """
+    Rasterize a single line as a mask with the ink at 255
+
+    returns: tuple (mask, x, y) with the position of the anchor in the mask
+    """
+    (left, top, right, bottom) = font.getbbox(text)
+    (x, y) = (max(0, -left), max(0, -top))
+    strip = PIL.Image.new('L', (x + right, y + bottom), 0)
+    PIL.ImageDraw.Draw(strip).text((x, y), text, 255, font=font)
+    return (strip, x, y)
+
+def draw(image, pieces, offset, font):
+    """
+    Draw the pieces of a layout in black onto the image with the anchor of
+    the text at offset, exactly like ImageDraw.multiline_text() would draw
+    the text
+    """
+    image_draw = PIL.ImageDraw.Draw(image)
+    for piece in pieces:
+        image_draw.text((offset[0] + piece.x, offset[1] + piece.y), piece.text, 0, font=font)
+
+def compose(image, pieces, offset, strip):
+    """
+    Draw the pieces of a layout in black onto the image with the anchor of
+    the text at offset. strip is called with the text of each piece and
+    returns its mask like draw_strip(). Pieces are placed at whole pixels,
+    so the mask of a line fits wherever the line moves to. That is within a
+    pixel of where ImageDraw.multiline_text() would draw it.
+    """
+    for piece in pieces:
+        (mask, mask_x, mask_y) = strip(piece.text)
+        image.paste(0, (round(offset[0] + piece.x) - mask_x,
+                        round(offset[1] + piece.y) - mask_y), mask)